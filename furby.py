@@ -23,6 +23,16 @@
 #  
 
 import struct
+import collections
+import io
+import json
+import hashlib
+import marshal
+import mmap
+import multiprocessing
+import os
+import time
+import numpy as np
 from PIL import Image as PILImage
 
 class FormatError(Exception):
@@ -37,14 +47,9 @@ class dlc(object):
 
 		def __init__(self, bytes_in=None):
 
-			if (bytes_in is not None):
-				self.rawbytes = str(bytes_in)
-				self.cursor = 0
-				self.length = len(bytes_in)
-			else:
-				self.rawbytes = ""
-				self.cursor = 0
-				self.length = 0
+			#Section contents live in a growable bytearray, or a read-only
+			#buffer into the source file until first written (see rawbytes below.)
+			self.rawbytes = bytes_in if (bytes_in is not None) else ""
 			
 			#Set up per-subclass stuff.
 			self.__initialise__()
@@ -52,12 +57,68 @@ class dlc(object):
 			#Return content pointer if initialisation stuff has messed it up.
 			self.__seek__(0)
 
+			#Remember what the parsed structures looked like, so that we
+			#can tell whether rawbytes still matches them.
+			self.clean_fingerprint = self.__fingerprint__() if (bytes_in is not None) else None
+
+		#Only the first self.length bytes of self.buffer are meaningful;
+		#anything past that is spare capacity for writes to grow into.
+		def __get_rawbytes__(self):
+			return bytes(self.buffer[:self.length])
+
+		def __set_rawbytes__(self, bytes_in):
+
+			#Buffers (e.g. slices of a mmapped DLC) are kept as they are, copy-on-write.
+			if (type(bytes_in) == buffer):
+				self.buffer = bytes_in
+			else:
+				self.buffer = bytearray(bytes_in)
+			self.length = len(self.buffer)
+			self.cursor = 0
+
+		rawbytes = property(__get_rawbytes__, __set_rawbytes__)
+
+		def __reserve__(self, numbytes):
+
+			#Take a private copy of read-only source bytes before changing anything.
+			if (type(self.buffer) != bytearray):
+				self.buffer = bytearray(self.buffer)
+
+			#Grow geometrically, so that a run of small writes is linear overall.
+			capacity = len(self.buffer)
+			if (numbytes > capacity):
+				self.buffer.extend(bytearray(max(numbytes, 2 * capacity) - capacity))
+
 		def __read__(self, numbytes):
 
-			s = self.rawbytes[self.cursor:self.cursor+numbytes]
+			end = min(self.cursor + numbytes, self.length)
+			s = bytes(self.buffer[self.cursor:end])
 			self.cursor += len(s)
 			return s
 
+		#Zero-copy, read-only view of this section's contents.
+		def view(self, offset=0, length=None):
+
+			if (length is None):
+				length = self.length - offset
+			return buffer(self.buffer, offset, length)
+
+		#Swaps rawbytes for a read-only copy and returns a view of it, so that
+		#it can be shared (e.g. with a fork()ed DLC) without changing under
+		#whoever holds it; the next write here takes a private copy first.
+		def __freeze__(self):
+
+			if (type(self.buffer) != buffer):
+				self.buffer = buffer(bytes(self.buffer[:self.length]))
+			return self.view()
+
+		#Swaps a read-only view (e.g. into a mmapped DLC) for a private copy,
+		#so that the source can be let go of.
+		def __detach__(self):
+
+			if (type(self.buffer) == buffer):
+				self.buffer = buffer(self.buffer[:self.length])
+
 		def __seek__(self, pos):
 
 			if (pos > self.length):
@@ -80,40 +141,126 @@ class dlc(object):
 			if (t == list):
 				for i in bytes_in:
 					self.__write__(i)
-			elif (t == str):
-				self.rawbytes = self.rawbytes[:self.cursor] + bytes_in + self.rawbytes[self.cursor+len(bytes_in):]
-				self.cursor += len(bytes_in)
+				return
 			elif (t == int):
-				self.rawbytes = self.rawbytes[:self.cursor] + chr(bytes_in) + self.rawbytes[self.cursor+len(bytes_in):]
-				self.cursor += 1
-			else:
-				raise TypeError("Do not know how to write objects of type " + str(t))		
+				bytes_in = chr(bytes_in)
+			elif (t not in (str, bytearray, buffer)):
+				raise TypeError("Do not know how to write objects of type " + str(t))
+
+			#Overwrite in place, growing the buffer if we run off the end.
+			end = self.cursor + len(bytes_in)
+			self.__reserve__(end)
+			self.buffer[self.cursor:end] = bytes_in
+			self.cursor = end
+			self.length = max(self.length, end)
+
+		#Precompiled little-endian structs, keyed on field width.
+		structs = {
+			1 : struct.Struct("<B"),
+			2 : struct.Struct("<H"),
+			4 : struct.Struct("<I"),
+		}
+		bulk_formats = {1 : "B", 2 : "H", 4 : "I"}
+		array_formats = {1 : "<u1", 2 : "<u2", 4 : "<u4"}
+		bulk_structs = {}
+
+		def __struct__(self, num_bytes, count=None):
+
+			if (num_bytes not in self.structs):
+				raise TypeError("Unknown data type of length " + str(num_bytes))
+
+			if (count is None):
+				return self.structs[num_bytes]
+
+			#(bulk_structs is a class attribute, so this cache is shared between all sections.)
+			key = (num_bytes, count)
+			if (key not in self.bulk_structs):
+				self.bulk_structs[key] = struct.Struct("<%d%s" % (count, self.bulk_formats[num_bytes]))
+			return self.bulk_structs[key]
+
+		#Unpacks a single struct at the cursor, and moves past it.
+		def __unpack_struct__(self, s):
+
+			if (self.cursor + s.size > self.length):
+				raise struct.error("unpack requires a buffer of %d bytes" % s.size)
+
+			vals = s.unpack_from(self.buffer, self.cursor)
+			self.cursor += s.size
+			return vals
 
 		def __unpack__(self, num_bytes=2):
 
-			if (num_bytes == 1):
-				return struct.unpack("<B", self.__read__(1))[0]
-			elif (num_bytes == 2):
-				return struct.unpack("<H", self.__read__(2))[0]
-			elif (num_bytes == 4):
-				return struct.unpack("<I", self.__read__(4))[0]
-			else:
-				raise TypeError("Unknown data type of length " + str(num_bytes))
+			return self.__unpack_struct__(self.__struct__(num_bytes))[0]
+
+		#Reads count values in one go.
+		def __unpack_many__(self, count, num_bytes=2):
+
+			if (count == 0):
+				return []
+			return list(self.__unpack_struct__(self.__struct__(num_bytes, count)))
+
+		#Reads values up to and including the first one equal to terminator.
+		def __unpack_until__(self, terminator, num_bytes=2):
+
+			self.__struct__(num_bytes)	#(checks num_bytes)
+			pos = self.cursor
+			chunk = 0x40
+
+			#Scan ahead a (growing) chunk of values at a time.
+			while (True):
+				count = min(chunk, (self.length - pos) / num_bytes)
+				if (count <= 0):
+					raise FormatError("Unterminated entry at offset 0x%x" % self.cursor)
+
+				vals = np.frombuffer(self.buffer, dtype=self.array_formats[num_bytes], count=count, offset=pos)
+				hits = np.flatnonzero(vals == terminator)
+				if (len(hits) > 0):
+					pos += num_bytes * hits[0]
+					break
+
+				pos += num_bytes * count
+				chunk *= 2
+
+			return self.__unpack_many__(((pos - self.cursor) / num_bytes) + 1, num_bytes)
 
 		def __pack__(self, int_in, num_bytes=2):
 
-			if (num_bytes == 1):
-				self.__write__(struct.pack("<B", int_in))
-			elif (num_bytes == 2):
-				self.__write__(struct.pack("<H", int_in))
-			elif (num_bytes == 4):
-				self.__write__(struct.pack("<I", int_in))
-			else:
-				raise TypeError("Unknown data type of length " + str(num_bytes))
+			self.__write__(self.__struct__(num_bytes).pack(int_in))
+
+		def __fingerprint__(self):
+
+			state = self.__state__()
+			if (state is None):
+				return None
+
+			h = hashlib.md5()
+			for chunk in state:
+				h.update(chunk)
+			return h.digest()
+
+		#True if the parsed structures have changed since rawbytes was last
+		#parsed or compiled (or if this section can't tell.)
+		def is_dirty(self):
+
+			return ((self.clean_fingerprint is None) or (self.__fingerprint__() != self.clean_fingerprint))
+
+		#Brings rawbytes up to date with the parsed structures.
+		#Only recompiles if something has changed; set force to recompile anyway.
+		def __recompile__(self, force=False):
+
+			if (force or self.is_dirty()):
+				self.__compile__()
+				self.clean_fingerprint = self.__fingerprint__()
+
+		#The compiled section, as a list of chunks to be written out in turn.
+		def __chunks__(self):
+
+			self.__recompile__()
+			return [self.view()]
 
-		def write_out(self, target=None):
+		def write_out(self, target=None, force=False):
 
-			self.__compile__()
+			self.__recompile__(force)
 			
 			#If no file handle supplied, simply return the string.
 			if (target is None):
@@ -121,7 +268,7 @@ class dlc(object):
 
 			#Otherwise, attempt to write to file handle.
 			else:
-				target.write(self.rawbytes)
+				target.write(self.view())
 
 		#Implement these per-class.
 		def __compile__(self):
@@ -133,6 +280,11 @@ class dlc(object):
 		def get_name(self):
 			raise NotImplementedError("Please implement a get_name() for this section!")
 
+		#Optionally implement this per-class: return a list of strings capturing
+		#everything __compile__() depends on. Sections without one are always recompiled.
+		def __state__(self):
+			return None
+
 	#Passes tests;
 	#couple of weird magic values tho
 	class HEADER_section(dlcsection):
@@ -153,7 +305,7 @@ class dlc(object):
 
 			#If this section has been initialised with a non-zero string
 			#of bytes, attempt to parse it.
-			if (self.rawbytes != ""):
+			if (self.length > 0):
 
 				#Check magic bytes.
 				self.__seek__(0)
@@ -256,57 +408,66 @@ class dlc(object):
 
 			self.palettes = []
 			
-			if (self.rawbytes != ""):
+			if (self.length > 0):
 				
-				num_palettes,leftover = divmod(len(self.rawbytes), self.palette_size)
+				num_palettes,leftover = divmod(self.length, self.palette_size)
 				assert(leftover == 0)
-				
-				for pal in range(num_palettes):
-					
-					this_pal = []
-					
-					for _ in range(self.num_colours):
-					
-						single_colour = self.__unpack__(2)
 
-						#Wacky 16-bit RGBA nonsense
-						R = ((single_colour & 0b0111110000000000) >> 7)
-						G = ((single_colour & 0b0000001111100000) >> 2)
-						B = ((single_colour & 0b0000000000011111) << 3)
-						A = ((single_colour & 0b1000000000000000) >> 8)
+				raw = np.frombuffer(self.buffer, dtype="<u2", count=(self.length / 2))
+				self.palettes = self.decode_colours(raw.reshape(num_palettes, self.num_colours))
 
-						if A == 0:
-							A = 0xff
-						else:
-							A = 0
+		#All palettes are held in one (num_palettes, num_colours, 4) uint8 array of (R,G,B,A);
+		#anything assigned to self.palettes (e.g. lists of extract_palette()s) is converted.
+		def __get_palettes__(self):
+			return self.palette_array
 
-						this_pal.append((R,G,B,A))
-					
-					assert(len(this_pal) == self.num_colours)
-					
-					self.palettes.append(this_pal)
+		def __set_palettes__(self, palettes_in):
+			self.palette_array = np.array(palettes_in, dtype=np.uint8).reshape(-1, self.num_colours, 4)
+
+		palettes = property(__get_palettes__, __set_palettes__)
+
+		#The palettes as the device sees them, one 16-bit word per colour.
+		@property
+		def raw_palettes(self):
+			return self.encode_colours(self.palettes)
+
+		#Wacky 16-bit RGBA nonsense, converted an array at a time.
+		@staticmethod
+		def decode_colours(raw):
+
+			raw = np.asarray(raw, dtype=np.uint16)
+			rgba = np.empty(raw.shape + (4,), dtype=np.uint8)
+
+			rgba[..., 0] = (raw & 0b0111110000000000) >> 7
+			rgba[..., 1] = (raw & 0b0000001111100000) >> 2
+			rgba[..., 2] = (raw & 0b0000000000011111) << 3
+			rgba[..., 3] = np.where(raw & 0b1000000000000000, 0, 0xff)
+
+			return rgba
+
+		@staticmethod
+		def encode_colours(rgba):
+
+			rgba = np.asarray(rgba, dtype=np.uint16)
+
+			R = (rgba[..., 0] & 0b11111000) << 7
+			G = (rgba[..., 1] & 0b11111000) << 2
+			B = (rgba[..., 2] & 0b11111000) >> 3
+			A = np.where(rgba[..., 3] == 0, 0b1000000000000000, 0).astype(np.uint16)
+
+			return (R | G | B | A)
 
 		def __compile__(self):
 
 			self.rawbytes = ""
-			self.__seek__(0)
-
-			for p in self.palettes:
-				for C in p:
-					
-					#Unpack into 16-bit RGBA.
-					
-					R = (C[0] & 0b11111000) << 7
-					G = (C[1] & 0b11111000) << 2
-					B = (C[2] & 0b11111000) >> 3
-					A = 0b1000000000000000 if (C[3] == 0) else 0
-					
-					single_colour = R+G+B+A
-					self.__pack__(single_colour, 2)
+			self.__write__(bytearray(self.raw_palettes.astype("<u2").tobytes()))
 
 		def get_name(self):
 			return "PAL"
 
+		def __state__(self):
+			return [marshal.dumps(self.palettes.shape), self.palettes.tobytes()]
+
 		def extract_palette(self, filename_in, pad=True):
 
 			im = PILImage.open(filename_in)
@@ -364,6 +525,7 @@ class dlc(object):
 		t1_terminator = 0x40
 		t3_terminator = 0xffff
 		t1_length = 0xe0
+		t1_struct = struct.Struct("<HIII")
 
 		channels_per_anim = 8
 
@@ -372,7 +534,12 @@ class dlc(object):
 			self.frame_playlists = []
 			self.frames = []
 
-			if (self.rawbytes != ""):
+			#Raw word offsets -> indices into self.frames and into the
+			#(t2) frame lists respectively. Kept up to date by __compile__().
+			self.frame_offset_index = {}
+			self.framelist_offset_index = {}
+
+			if (self.length > 0):
 				
 				#Get type-1 entries.
 				#[length of t2 entry, offset to t2 entry, ???(perhaps layer number?), terminator (0x40)]
@@ -381,7 +548,7 @@ class dlc(object):
 				
 				for w in range(16):
 
-					raw_vals = [self.__unpack__(2), self.__unpack__(4), self.__unpack__(4), self.__unpack__(4)]
+					raw_vals = list(self.__unpack_struct__(self.t1_struct))
 					
 					assert(raw_vals[-1] == self.t1_terminator)
 					
@@ -397,7 +564,7 @@ class dlc(object):
 				#Get type-2 entries (pointers to whole frames)
 				for w in range(16):
 					self.__seek__(self.frame_playlists[w]["t2_offset_raw"]*2)
-					self.frame_playlists[w]["t3_offsets_raw"] = [self.__unpack__(4) for _ in range(self.frame_playlists[w]["framecount"])]
+					self.frame_playlists[w]["t3_offsets_raw"] = self.__unpack_many__(self.frame_playlists[w]["framecount"], 4)
 
 
 				#Get type-3 entries (whole frames, as a sequence of quarter-frames)
@@ -408,7 +575,7 @@ class dlc(object):
 						frame_offset = self.frame_playlists[w]["t3_offsets_raw"][i] 
 						
 						self.__seek__(frame_offset * 2)
-						interim_frames[frame_offset] = [self.__unpack__(2) for _ in range(9)]
+						interim_frames[frame_offset] = self.__unpack_many__(9, 2)
 						assert(interim_frames[frame_offset][-1] == self.t3_terminator)
 
 				#Build "frames", checking for missing/unreferenced frames.
@@ -422,13 +589,14 @@ class dlc(object):
 				self.frames = [interim_frames[i] for i in all_frame_offsets]
 
 				#Fix up t3 indices.
+				self.frame_offset_index = { o : i for i, o in enumerate(all_frame_offsets) }
 				for w in range(16):
-					self.frame_playlists[w]["frame_indices"] = [all_frame_offsets.index(i) for i in self.frame_playlists[w]["t3_offsets_raw"]]
+					self.frame_playlists[w]["frame_indices"] = [self.frame_offset_index[i] for i in self.frame_playlists[w]["t3_offsets_raw"]]
 
 				#Fix up t2 indices.
-				t2offsets = sorted(list(t2offsets))
+				self.framelist_offset_index = { o : i for i, o in enumerate(sorted(t2offsets)) }
 				for w in range(16):
-					self.frame_playlists[w]["framelist_index"] = t2offsets.index(self.frame_playlists[w]["t2_offset_raw"])
+					self.frame_playlists[w]["framelist_index"] = self.framelist_offset_index[self.frame_playlists[w]["t2_offset_raw"]]
 				assert(set([w["framelist_index"] for w in self.frame_playlists]) == set(range(16)))
 
 		def __compile__(self):
@@ -437,7 +605,7 @@ class dlc(object):
 			self.__seek__(0)
 
 			#build t3.
-			t3_raw = ""
+			t3_raw = bytearray()
 			for f in self.frames:
 				for i in f:
 					t3_raw += struct.pack("<H", i)
@@ -447,9 +615,10 @@ class dlc(object):
 			assert(checknum == 0)
 			for w in range(16):
 				self.frame_playlists[w]["t3_offsets_raw"] = [ ((i * 9) + word_offset) for i in self.frame_playlists[w]["frame_indices"] ]
+			self.frame_offset_index = { ((i * 9) + word_offset) : i for i in range(len(self.frames)) }
 
 			#Fix up t2 offsets (and build t2.)
-			t2_raw = ""
+			t2_raw = bytearray()
 			word_offset, checknum = divmod((self.t1_length+len(t3_raw)),2)
 			assert(checknum == 0)
 			ordered_by_t2_index = sorted(range(len(self.frame_playlists)), key=lambda w : self.frame_playlists[w]["framelist_index"])
@@ -459,6 +628,7 @@ class dlc(object):
 				
 				for i in self.frame_playlists[w]["t3_offsets_raw"]:
 					t2_raw += struct.pack("<I", i)
+			self.framelist_offset_index = { w["t2_offset_raw"] : w["framelist_index"] for w in self.frame_playlists }
 
 			#Build t1.
 			for w in range(16):
@@ -476,6 +646,36 @@ class dlc(object):
 		def get_name(self):
 			return "SPR"
 
+		#Merges identical frames and drops frames that no playlist uses,
+		#renumbering frame_indices to match. Frames that end up shared
+		#are shared for good, so make any per-playlist edits first.
+		#Returns the number of frames removed.
+		def compact_frames(self, merge=True):
+
+			referenced = sorted(set(i for w in self.frame_playlists for i in w["frame_indices"]))
+
+			new_frames = []
+			first_copy = {}
+			renumber = {}
+			for i in referenced:
+				key = tuple(self.frames[i]) if merge else i
+				if key not in first_copy:
+					first_copy[key] = len(new_frames)
+					new_frames.append(list(self.frames[i]))
+				renumber[i] = first_copy[key]
+
+			for w in self.frame_playlists:
+				w["frame_indices"] = [renumber[i] for i in w["frame_indices"]]
+
+			removed = len(self.frames) - len(new_frames)
+			self.frames = new_frames
+			return removed
+
+		def __state__(self):
+
+			playlists = [(w["framecount"], w["layer"], w["frame_indices"], w["framelist_index"]) for w in self.frame_playlists]
+			return [marshal.dumps((playlists, self.frames))]
+
 		def analyse_frames(self, anim_no, frame_no):
 			
 			thisframe = self.anim_tree[anim_no]["frames"][frame_no]
@@ -505,7 +705,7 @@ class dlc(object):
 
 		def __initialise__(self):
 
-			self.cels = []
+			self.cel_array = []
 
 			#Make sure I haven't screwed up the maths
 			assert(self.frame_height * self.frame_width == self.frame_length)
@@ -514,157 +714,229 @@ class dlc(object):
 
 			#If this section has been initialised with a non-zero string
 			#of bytes, attempt to parse it.
-			if (self.rawbytes != ""):
+			if (self.length > 0):
 
-				num_cels, cel_remainder = divmod(len(self.rawbytes), self.frame_length)
+				num_cels, cel_remainder = divmod(self.length, self.frame_length)
 
 				try:
 					assert(cel_remainder == 0)
 				except:
-					raise FormatError("Badly formed CEL section (length %d)" % len(self.rawbytes))
+					raise FormatError("Badly formed CEL section (length %d)" % self.length)
 
 				#The cels section is pretty straightforward.
-				#raw_cels = [self.rawbytes[i:(i+self.frame_length)] for i in range(0, len(self.rawbytes), self.frame_length)]
-				for _ in range(num_cels):
+				#Three bytes give four pixels, so split every row into 3-byte groups.
+				bytevals = np.frombuffer(self.buffer, dtype=np.uint8, count=self.length)
+				bytevals = bytevals.reshape(num_cels, self.frame_height, self.frame_width / 3, 3)
 
-					this_cel = []
-					
-					for row in range(self.frame_height):
+				pixels = np.empty((num_cels, self.frame_height, self.frame_width / 3, 4), dtype=np.uint8)
+				pixels[..., 0] = (bytevals[..., 0] >> 2)
+				pixels[..., 1] = ((bytevals[..., 0] & 0x03) << 4) | (bytevals[..., 1] >> 4)
+				pixels[..., 2] = ((bytevals[..., 1] & 0x0f) << 2) | (bytevals[..., 2] >> 6)
+				pixels[..., 3] = (bytevals[..., 2] & 0x3f)
 
-						this_row = []
-						
-						#Yields four pixels per iteration.
-						for column in range(self.frame_width/3):
+				self.cel_array = pixels.reshape(num_cels, self.cel_height, self.cel_width)
 
-							#Three bytes give four pixels.
-							bytevals = [self.__unpack__(1) for i in range(3)]
+		#All cels are held in one (capacity, height, width) uint8 array, which
+		#grows geometrically like rawbytes does; cel_array is the part in use.
+		#Anything assigned to it (e.g. a list of quarterize()d cels) is converted.
+		def __get_cel_array__(self):
+			return self.cel_store[:self.cel_count]
 
-							pixels = [
-								(bytevals[0] >> 2),
-								((bytevals[0] & 0x03) << 4 ) + (bytevals[1] >> 4),
-								((bytevals[1] & 0x0f) << 2 ) + (bytevals[2] >> 6),
-								(bytevals[2] & 0x3f)
-							]
+		def __set_cel_array__(self, cels_in):
 
-							for pixel in pixels:
-								this_row.append(pixel)
+			self.cel_store = np.array(cels_in, dtype=np.uint8).reshape(-1, self.cel_height, self.cel_width)
+			self.cel_count = len(self.cel_store)
 
-						assert(len(this_row) == self.cel_width)
-						this_cel.append(this_row)
+		cel_array = property(__get_cel_array__, __set_cel_array__)
 
-					self.cels.append(this_cel)
+		def __reserve_cels__(self, count):
 
-		def __compile__(self):
+			capacity = len(self.cel_store)
+			if (count > capacity):
+				grown = np.zeros((max(count, 2 * capacity), self.cel_height, self.cel_width), dtype=np.uint8)
+				grown[:self.cel_count] = self.cel_array
+				self.cel_store = grown
 
-			self.rawbytes = ""
-			self.__seek__(0)
+		#self.cels behaves like the list of cels it used to be: cels[n][y][x],
+		#slices (which are lists), +, append() and so on all work as before.
+		#Each cel is a view into cel_array, which vectorised code can use directly.
+		class cel_list(collections.MutableSequence):
 
-			#Pretty easy.
-			for cel in self.cels:
+			def __init__(self, section):
+				self.section = section
 
-				for row in range(self.cel_height):
-					
-					#four pixels are packed into three bytes.
-					assert(len(cel[row]) == self.cel_width)
-					for column in range(self.cel_width / 4):
+			def __len__(self):
+				return self.section.cel_count
 
-						pixels = cel[row][(column*4):((column+1)*4)]
-						
-						bytevals = [
-							(pixels[0] << 2) + (pixels[1] >> 4),
-							((pixels[1] & 0x0f) << 4) + (pixels[2] >> 2),
-							((pixels[2] & 0x03) << 6) + pixels[3]
-						]
+			def __getitem__(self, key):
 
-						for b in bytevals:
-							self.__pack__(b, 1)
+				if (isinstance(key, slice)):
+					return [self.section.cel_array[i] for i in range(*key.indices(len(self)))]
+				return self.section.cel_array[key]
 
+			def __setitem__(self, key, cel_in):
 
-		def get_name(self):
-			return "CEL"
+				if (isinstance(key, slice)):
+					cels = list(self)
+					cels[key] = list(cel_in)
+					self.section.cel_array = cels
+				else:
+					self.section.cel_array[key] = cel_in
 
-		def draw_frame_greyscale(self, cel_number, filename_out):
+			def __delitem__(self, key):
 
-			im = PILImage.new("RGB", (self.cel_width, self.cel_height), "white")
+				cels = list(self)
+				del cels[key]
+				self.section.cel_array = cels
 
-			cel = self.cels[cel_number]
+			def insert(self, pos, cel_in):
 
-			for y in range(self.cel_height):
-				for x in range(self.cel_width):
-					
-					col = (cel[y][x]<<2,) * 3
-					
-					im.putpixel((x,y), col)
+				count = len(self)
+				pos = min(max(pos + count, 0) if (pos < 0) else pos, count)
 
-			im.save(filename_out)
+				self.section.__reserve_cels__(count + 1)
+				store = self.section.cel_store
+				store[pos + 1:count + 1] = store[pos:count]
+				store[pos] = cel_in
+				self.section.cel_count = count + 1
 
-		def quarterize(self, filename_in, demo_palette=None):
+			def __iter__(self):
+				return iter(self.section.cel_array)
 
-			quarters = []
+			def __add__(self, other):
+				return list(self) + list(other)
 
-			try:
-				im = PILImage.open(filename_in)
-				im.seek(0)
-			except:
-				return quarters
+			def __radd__(self, other):
+				return list(other) + list(self)
 
-			while(True):
+		def __get_cels__(self):
+			return self.cel_list(self)
 
-				w, h = im.size
-				assert(w == (2*self.cel_width))
-				assert(h == (2*self.cel_height))
+		def __set_cels__(self, cels_in):
 
-				im_quarters = [[], [], [], []]
-				im_x = [(0,w/2),(w/2,w),(0,w/2),(w/2,w)]
-				im_y = [(0,h/2),(0,h/2),(h/2,h),(h/2,h)]
+			if (isinstance(cels_in, self.cel_list)):
+				cels_in = cels_in.section.cel_array
+			self.cel_array = cels_in
 
+		cels = property(__get_cels__, __set_cels__)
 
-				for i in range(4):
+		def __compile__(self):
 
-					for y in range(im_y[i][0],im_y[i][1]):
+			self.rawbytes = ""
 
-						thisrow = []
+			cels = self.cel_array
+			if (len(cels) > 0 and cels.max() > 0x3f):
+				raise FormatError("Cel pixels must be 6-bit palette indices.")
 
-						for x in range(im_x[i][0],im_x[i][1]):
+			#Pretty easy: four pixels are packed into three bytes.
+			pixels = cels.reshape(len(cels), self.cel_height, self.cel_width / 4, 4)
 
-							pix = im.getpixel((x,y))
+			bytevals = np.empty((len(cels), self.cel_height, self.cel_width / 4, 3), dtype=np.uint8)
+			bytevals[..., 0] = (pixels[..., 0] << 2) | (pixels[..., 1] >> 4)
+			bytevals[..., 1] = ((pixels[..., 1] & 0x0f) << 4) | (pixels[..., 2] >> 2)
+			bytevals[..., 2] = ((pixels[..., 2] & 0x03) << 6) | pixels[..., 3]
 
-							thisrow.append(pix)
+			self.__write__(bytearray(bytevals.tobytes()))
 
-						im_quarters[i].append(thisrow)
+		def get_name(self):
+			return "CEL"
 
-				if demo_palette is not None:
+		def __state__(self):
+			return [marshal.dumps(self.cel_array.shape), self.cel_array.tobytes()]
 
-					for i in range(4):
-						self.peek_image(im_quarters[i], demo_palette)
+		#Renders a cel (or any 2D array of palette indices) as a PIL image.
+		#With no palette, the indices are drawn as greys.
+		#If indexed is set, a "P"-mode image is returned with the palette
+		#(and its transparency) attached, rather than an RGBA one.
+		def render_cel(self, cel_in, palette=None, indexed=False):
 
-				for q in im_quarters:
-					quarters.append(q)
+			if (isinstance(cel_in, (int, long))):
+				cel_in = self.cel_array[cel_in]
+			cel = np.ascontiguousarray(cel_in, dtype=np.uint8)
 
-				try:
-					im.seek(im.tell()+1)
-				except EOFError:
-					break
+			if (palette is None):
+				return PILImage.fromarray(cel << 2, "L").convert("RGB")
 
-			im.close()
-			return quarters
+			palette = np.asarray(palette, dtype=np.uint8)
 
-		def peek_image(self, im_in, colourmap_in):
+			if (indexed):
+				im = PILImage.fromarray(cel, "P")
+				im.putpalette(palette[:, :3].tobytes())
+				im.info["transparency"] = palette[:, 3].tobytes()
+				return im
+
+			#One lookup for the whole cel.
+			return PILImage.fromarray(np.ascontiguousarray(palette[cel]), "RGBA")
+
+		def draw_frame_greyscale(self, cel_number, filename_out=None):
+
+			im = self.render_cel(cel_number)
+
+			if (filename_out is not None):
+				im.save(filename_out)
+			return im
+
+		#Yields the quarters of each frame of a 128x128 gif in turn
+		#(top-left, top-right, bottom-left, bottom-right), as 64x64 arrays.
+		def iter_quarters(self, filename_in):
+
+			try:
+				im = PILImage.open(filename_in)
+				im.seek(0)
+			except:
+				return
+
+			try:
+				while(True):
+
+					w, h = im.size
+					assert(w == (2*self.cel_width))
+					assert(h == (2*self.cel_height))
+
+					#Grab the whole frame's palette indices at once, then slice it up.
+					frame = np.asarray(im, dtype=np.uint8)
+					for y in (0, self.cel_height):
+						for x in (0, self.cel_width):
+							yield frame[y:(y+self.cel_height), x:(x+self.cel_width)]
+
+					try:
+						im.seek(im.tell()+1)
+					except EOFError:
+						break
+			finally:
+				im.close()
 
-			h = len(im_in)
-			w = len(im_in[0])
+		def quarterize(self, filename_in, demo_palette=None):
+
+			quarters = list(self.iter_quarters(filename_in))
+
+			if demo_palette is not None:
+				for q in quarters:
+					self.peek_image(q, demo_palette)
 
-			im = PILImage.new("RGBA", (w,h))
+			return quarters
+
+		#Quarterizes a gif straight into the cel array, inserting the new
+		#cels at pos (or appending them.) Returns the new cels' numbers.
+		#This doesn't touch the SPR section; dlc.import_gif() renumbers its
+		#frames too, so that they keep showing the same cels.
+		def import_gif(self, filename_in, pos=None):
 
-			for y in range(h):
-				for x in range(w):
+			quarters = list(self.iter_quarters(filename_in))
+			if (pos is None):
+				pos = self.cel_count
 
-					pix = im_in[y][x]
-					col = colourmap_in[pix]
+			if (len(quarters) > 0):
+				cels = self.cel_array
+				self.cel_array = np.concatenate([cels[:pos], np.array(quarters, dtype=np.uint8), cels[pos:]])
 
-					im.putpixel((x,y), col)
+			return range(pos, pos + len(quarters))
 
+		def peek_image(self, im_in, colourmap_in):
+
+			im = self.render_cel(im_in, colourmap_in)
 			im.show()
+			return im
 
 		def analyse_colours(self, cel_no):
 			
@@ -684,6 +956,138 @@ class dlc(object):
 	class XLS_section(dlcsection):
 
 		default_header_entry_length = 0x03
+		t1_struct = struct.Struct("<HI")
+		t3_struct = struct.Struct("<HHHIHHHHH")
+		t4_struct = struct.Struct("<HHHHH")
+
+		#One entry in the action tree. Type-1 to -3 entries point at a run
+		#of child entries (their "children"); type-4 entries are the leaves.
+		#raw holds the nine type-3 values, or the five type-4 values.
+		#Entries can still be indexed like the dicts they replace, so
+		#action_tree[a][b][c][d]["seq"] and friends work as they always have,
+		#and old-style dicts assigned as children are converted. "entries" and
+		#"length" follow the children: setting them drops trailing children
+		#(add children with entry[len(entry.children)] = child), and
+		#"callable" is worked out from raw.
+		class xls_entry(object):
+
+			__slots__ = ("level", "address", "points_at", "raw", "children")
+
+			#Size (in bytes) of each child entry, per level.
+			child_lengths = {1 : 6, 2 : 20, 3 : 10}
+
+			#The keys the old dict entries had (besides child numbers), per level.
+			legacy_keys = {
+				1 : ["address", "points_at", "entries", "length"],
+				2 : ["address", "points_at", "entries", "length"],
+				3 : ["address", "points_at", "entries", "length", "callable", "raw"],
+				4 : ["address", "rawbytes", "bytes", "vals", "seq"],
+			}
+
+			def __init__(self, level, address, points_at=None, raw=None):
+				self.level = level
+				self.address = address
+				self.points_at = points_at
+				self.raw = raw
+				self.children = [] if (level < 4) else None
+
+			def keys(self):
+				return self.legacy_keys[self.level] + (range(len(self.children)) if (self.children is not None) else [])
+
+			def __contains__(self, key):
+
+				if (isinstance(key, (int, long))):
+					return ((self.children is not None) and (0 <= key < len(self.children)))
+				return (key in self.legacy_keys[self.level])
+
+			def __getitem__(self, key):
+
+				if (key not in self):
+					raise KeyError(key)
+
+				if (isinstance(key, (int, long))):
+					return self.children[key]
+				elif (key == "address"):
+					return self.address
+				elif (key == "points_at"):
+					return self.points_at
+				elif (key == "entries"):
+					return len(self.children)
+				elif (key == "length"):
+					return self.child_lengths[self.level] * len(self.children)
+				elif (key == "raw"):
+					return self.raw
+				elif (key == "callable"):
+					#Whether or not this is one of the nondefault callable DLC actions.
+					return (
+						self.raw[0] == 0		and
+						self.raw[1] == 0x64	and
+						self.raw[4] == 5   	and
+						self.raw[5] == 0   	and
+						self.raw[6] == 0   	and
+						self.raw[7] == 0   	and
+						self.raw[8] == 0
+					)
+				elif (key == "vals"):
+					return self.raw
+				elif (key == "rawbytes"):
+					return dlc.XLS_section.t4_struct.pack(*self.raw)
+				elif (key == "bytes"):
+					return [hex(ord(b)) for b in self["rawbytes"]]
+				elif (key == "seq"):
+					return (self.raw[0] & 0xff)
+
+			def __setitem__(self, key, value):
+
+				if (isinstance(key, (int, long)) and (self.children is not None) and (0 <= key <= len(self.children))):
+					if (isinstance(value, dict)):
+						value = self.from_dict(self.level + 1, value)
+					self.children[key:key+1] = [value]
+				elif (key in ("address", "points_at")):
+					setattr(self, key, value)
+				elif ((key in ("entries", "length")) and (self.children is not None)):
+					count = value if (key == "entries") else (value / self.child_lengths[self.level])
+					if (count > len(self.children)):
+						raise FormatError("Entry has %d children; add more with entry[n] = child." % len(self.children))
+					del self.children[count:]
+				elif ((key == "raw") and (self.level == 3)):
+					self.raw = list(value)
+				elif ((key == "vals") and (self.level == 4)):
+					self.raw = tuple(value)
+				elif ((key == "rawbytes") and (self.level == 4)):
+					self.raw = dlc.XLS_section.t4_struct.unpack(value)
+				elif ((key == "bytes") and (self.level == 4)):
+					self.raw = dlc.XLS_section.t4_struct.unpack("".join(chr(int(b, 16)) for b in value))
+				elif ((key == "seq") and (self.level == 4)):
+					self.raw = ((self.raw[0] & 0xff00) | (value & 0xff),) + tuple(self.raw[1:])
+				else:
+					raise KeyError(key)
+
+			#Builds an entry (and everything under it) from an old-style dict.
+			@classmethod
+			def from_dict(cls, level, d):
+
+				if (level == 4):
+					raw = tuple(d["vals"]) if ("vals" in d) else dlc.XLS_section.t4_struct.unpack(d["rawbytes"])
+					return cls(4, d.get("address"), raw=raw)
+
+				entry = cls(level, d.get("address"), d.get("points_at"), (list(d["raw"]) if (level == 3) else None))
+				for n in range(d.get("entries", len([k for k in d if isinstance(k, (int, long))]))):
+					entry[n] = d[n]
+				return entry
+
+			def get(self, key, default=None):
+				return self[key] if (key in self) else default
+
+			#A copy of this entry (and everything under it) as plain dicts,
+			#exactly as the action tree used to be stored.
+			def as_dict(self):
+
+				d = {}
+				for k in self.keys():
+					v = self[k]
+					d[k] = v.as_dict() if isinstance(v, dlc.XLS_section.xls_entry) else v
+				return d
 
 		def __initialise__(self):
 			self.action_tree = {}
@@ -691,7 +1095,7 @@ class dlc(object):
 
 			#If this section has been initialised with a non-zero string
 			#of bytes, attempt to parse it.
-			if (self.rawbytes != ""):
+			if (self.length > 0):
 
 				# Get first word. "Number of type-1 entries"
 				type1_count = self.__unpack__(2)
@@ -702,6 +1106,8 @@ class dlc(object):
 				# Prepare to start moving through the tree, width-first (it's
 				# inefficient, but cuts down the amount of seek()s we need to 
 				# do, making the code a lot more straightforward to read.)
+				# Child counts are kept alongside until the children are read.
+				counts = {}
 
 				# Start with type-1 entries.
 				for i in range(1,type1_count+1):
@@ -709,64 +1115,46 @@ class dlc(object):
 					#The address of this particular entry.
 					iaddress = self.__tell__()
 
-					#The length of the type-2 entry this points to (in 6-byte entries)
-					ilength = self.__unpack__(2)
-
-					#The offset of that type2-entry (in words from the start of this section)
-					ioffset = self.__unpack__(4)
+					#The length of the type-2 entry this points to (in 6-byte entries),
+					#and the offset of that type2-entry (in words from the start of this section)
+					ilength, ioffset = self.__unpack_struct__(self.t1_struct)
 					
-					self.action_tree[i] = {
-						"address"	:	iaddress,
-						"points_at"	:	(2*ioffset),
-						"entries"	:	ilength,
-						"length"	:	(6*ilength)
-					}
+					self.action_tree[i] = self.xls_entry(1, iaddress, (2*ioffset))
+					counts[i] = ilength
 
 				# Now type-2 entries.
 				for i in range(1,type1_count+1):
 					
-					self.__seek__(self.action_tree[i]["points_at"])
-					for j in range(self.action_tree[i]["entries"]):
+					self.__seek__(self.action_tree[i].points_at)
+					for j in range(counts[i]):
 
 						#The address of this particular entry.
 						jaddress = self.__tell__()
 
-						#The length of the type-3 entry this points to (in 20-byte entries)
-						jlength = self.__unpack__(2)
-
-						#The offset of that type3-entry (in words from the start of this section) 
-						joffset = self.__unpack__(4)
+						#The length of the type-3 entry this points to (in 20-byte entries),
+						#and the offset of that type3-entry (in words from the start of this section) 
+						jlength, joffset = self.__unpack_struct__(self.t1_struct)
 						
-						self.action_tree[i][j] = {
-							"address"	:	jaddress,
-							"points_at"	:	(2*joffset),
-							"entries"	:	jlength,
-							"length"	:	(20*jlength)
-						}
+						self.action_tree[i].children.append(self.xls_entry(2, jaddress, (2*joffset)))
+						counts[i, j] = jlength
 
 
 				# Next, type-3 entries.
 				for i in range(1,type1_count+1):
-					for j in range(self.action_tree[i]["entries"]):
+					for j in range(counts[i]):
 						
-						self.__seek__(self.action_tree[i][j]["points_at"])
-						for k in range(self.action_tree[i][j]["entries"]):
+						self.__seek__(self.action_tree[i][j].points_at)
+						for k in range(counts[i, j]):
 							
 							#The address of this particular entry.
 							kaddress = self.__tell__()
 							
 							#kbamf = [ "{0:0{1}x}".format(self.__unpack__(1),2) for _ in range(20) ]
-							kbamf = [
-								self.__unpack__(2),	#often zero
-								self.__unpack__(2),	#often 0x64 (100d)
-								self.__unpack__(2),	#length of type-4 entry this points to (in 10-byte entries)
-								self.__unpack__(4),	#The offset of that type-4 entry (in words from the start of this section)
-								self.__unpack__(2),	#seems to be a small integer, [1:9]
-								self.__unpack__(2),	#often zero
-								self.__unpack__(2),	#often zero
-								self.__unpack__(2),	#often zero
-								self.__unpack__(2),	#often zero
-							]
+							#[often zero, often 0x64 (100d),
+							# length of type-4 entry this points to (in 10-byte entries),
+							# the offset of that type-4 entry (in words from the start of this section),
+							# seems to be a small integer [1:9], then four words that are often zero]
+							kbamf = list(self.__unpack_struct__(self.t3_struct))
 							
 							#The length of the type-4 entry this points to (in 10-byte entries)
 							#klength = int(''.join(kbamf[5:3:-1]), 16)
@@ -775,66 +1163,80 @@ class dlc(object):
 							#The offset of that type-4 entry (in words from the start of this section) 
 							#koffset = int(''.join(kbamf[9:5:-1]), 16)
 							koffset = kbamf[3]
-							
-							#Whether or not this is one of the nondefault callable DLC actions.
-							#kcallable = (
-								#kbamf[0:4] == ["00", "00", "64", "00"] and
-								#kbamf[10:] == (["05"] + (["00"]*9))
-							#)
-							kcallable = (
-								kbamf[0] == 0		and
-								kbamf[1] == 0x64	and
-								kbamf[4] == 5   	and
-								kbamf[5] == 0   	and
-								kbamf[6] == 0   	and
-								kbamf[7] == 0   	and
-								kbamf[8] == 0
-							)
-
-							self.action_tree[i][j][k] = {
-								"address"	:	kaddress,
-								"points_at"	:	(2*koffset),
-								"entries"	:	klength,
-								"length"	:	(10*klength),
-								"callable"	:	kcallable,
-								"raw"     	:	kbamf
-							}
+
+							self.action_tree[i][j].children.append(self.xls_entry(3, kaddress, (2*koffset), kbamf))
+							counts[i, j, k] = klength
 
 
 				# Finally, type-4 entries.
 				for i in range(1,type1_count+1):
-					for j in range(self.action_tree[i]["entries"]):
-						for k in range(self.action_tree[i][j]["entries"]):
+					for j in range(counts[i]):
+						for k in range(counts[i, j]):
 
-							self.__seek__(self.action_tree[i][j][k]["points_at"])
-							for l in range(self.action_tree[i][j][k]["entries"]):
+							self.__seek__(self.action_tree[i][j][k].points_at)
+							for l in range(counts[i, j, k]):
 
 								#The address of this particular entry.
 								laddress = self.__tell__()
 								
-								rawbytes = self.__read__(10)
-								unboxing = struct.unpack("<HHHHH", rawbytes)
-								
-								self.action_tree[i][j][k][l] = {
-									"address"	:	laddress,
-									"rawbytes"	:	rawbytes,
-									"bytes"		:	[hex(ord(b)) for b in rawbytes],
-									"vals"		:	unboxing,
-									"seq"		:	ord(rawbytes[0])
-								}
+								self.action_tree[i][j][k].children.append(self.xls_entry(4, laddress, raw=self.__unpack_struct__(self.t4_struct)))
+
+		#Converts any old-style dicts put straight into action_tree.
+		def __normalise__(self):
+
+			for i in self.action_tree:
+				if (isinstance(self.action_tree[i], dict)):
+					self.action_tree[i] = self.xls_entry.from_dict(1, self.action_tree[i])
+
+		#{ (a,b,c,d) : type-4 entry } for the whole tree, as it is now.
+		#This walks every entry, so build it once for whole-tree passes;
+		#to find a single action code, use lookup().
+		def build_leaf_index(self):
+
+			self.__normalise__()
+
+			leaves = {}
+			for i, t1 in self.action_tree.items():
+				for j, t2 in enumerate(t1.children):
+					for k, t3 in enumerate(t2.children):
+						for l, t4 in enumerate(t3.children):
+							leaves[(i, j, k, l)] = t4
+			return leaves
+
+		#The type-4 entry for an action code, e.g. lookup((75,0,0,0))["seq"].
+		#Goes straight down the tree, so edits are always picked up.
+		def lookup(self, action_code):
+
+			a, b, c, d = action_code
+			try:
+				assert(min(b, c, d) >= 0)
+				if (isinstance(self.action_tree[a], dict)):
+					self.action_tree[a] = self.xls_entry.from_dict(1, self.action_tree[a])
+				return self.action_tree[a].children[b].children[c].children[d]
+			except (AssertionError, IndexError, KeyError):
+				raise KeyError(tuple(action_code))
+
+		#A copy of the whole action tree as nested dicts, the way it used to be stored.
+		def as_dict(self):
+			return { i : self.action_tree[i].as_dict() for i in self.action_tree }
 
 		def __compile__(self):
 
 			#Initialise.
 			self.rawbytes = ""
 			self.__seek__(0)
+			self.__normalise__()
+
+			type1 = [self.action_tree[i] for i in self.action_tree]
+			type2 = [j for i in type1 for j in i.children]
+			type3 = [k for j in type2 for k in j.children]
+			type4 = [l for k in type3 for l in k.children]
 
 			#Work out the sizes of the type-1, -2, -3, and -4 sub-sections.
-			#(please forgive the horrible one-liners)
-			type1_len = 6 * (1 + len(self.action_tree))
-			type2_len = sum([(6 * self.action_tree[i]["entries"]) for i in self.action_tree])
-			type3_len = sum([sum([20 * self.action_tree[i][j]["entries"] for j in range(self.action_tree[i]["entries"])]) for i in self.action_tree])
-			type4_len = sum([sum([sum([10 * self.action_tree[i][j][k]["entries"] for k in range(self.action_tree[i][j]["entries"])]) for j in range(self.action_tree[i]["entries"])]) for i in self.action_tree])
+			type1_len = 6 * (1 + len(type1))
+			type2_len = 6 * len(type2)
+			type3_len = 20 * len(type3)
+			type4_len = 10 * len(type4)
 
 			#Prepopulate this section's content with zeroes (as we'll 
 			#be hopping around quite a bit.)
@@ -848,61 +1250,54 @@ class dlc(object):
 			self.__pack__(self.header_entry_length, 4)
 
 			#Start laying down type-1 entries.
-			for i in self.action_tree:
+			for i in type1:
 
-				#The length of the type-2 entry this points to (in 6-byte entries)
-				self.__pack__(self.action_tree[i]["entries"], 2)
-
-				#The offset of that type2-entry (in words from the start of this section)
-				self.__pack__((self.action_tree[i]["points_at"] >> 1), 4)
+				#The length of the type-2 entry this points to (in 6-byte entries),
+				#and the offset of that type2-entry (in words from the start of this section)
+				self.__write__(self.t1_struct.pack(len(i.children), (i.points_at >> 1)))
 
 			#Now lay down type-2 entries.
-			for i in self.action_tree:
-
-				self.__seek__(self.action_tree[i]["points_at"])
-				for j in range(self.action_tree[i]["entries"]):
+			for i in type1:
 
-					#The length of the type-3 entry this points to (in 20-byte entries)
-					self.__pack__(self.action_tree[i][j]["entries"], 2)
+				self.__seek__(i.points_at)
+				for j in i.children:
 
-					#The offset of that type2-entry (in words from the start of this section)
-					self.__pack__((self.action_tree[i][j]["points_at"] >> 1), 4)
+					#The length of the type-3 entry this points to (in 20-byte entries),
+					#and the offset of that type2-entry (in words from the start of this section)
+					self.__write__(self.t1_struct.pack(len(j.children), (j.points_at >> 1)))
 
 			#Next, lay down type-3 entries.
-			for i in self.action_tree:
-				for j in range(self.action_tree[i]["entries"]):
-					
-					self.__seek__(self.action_tree[i][j]["points_at"])
-					for k in range(self.action_tree[i][j]["entries"]):
-						
-						 self.__pack__(self.action_tree[i][j][k]["raw"][0], 2)
-						 self.__pack__(self.action_tree[i][j][k]["raw"][1], 2)
-						 self.__pack__(self.action_tree[i][j][k]["raw"][2], 2)
-						 self.__pack__(self.action_tree[i][j][k]["raw"][3], 4)
-						 self.__pack__(self.action_tree[i][j][k]["raw"][4], 2)
-						 self.__pack__(self.action_tree[i][j][k]["raw"][5], 2)
-						 self.__pack__(self.action_tree[i][j][k]["raw"][6], 2)
-						 self.__pack__(self.action_tree[i][j][k]["raw"][7], 2)
-						 self.__pack__(self.action_tree[i][j][k]["raw"][8], 2)
+			for j in type2:
+				
+				self.__seek__(j.points_at)
+				for k in j.children:
+					self.__write__(self.t3_struct.pack(*k.raw))
 
 			#Finally, lay down type-4 entries.
-			for i in self.action_tree:
-					for j in range(self.action_tree[i]["entries"]):
-						for k in range(self.action_tree[i][j]["entries"]):
-
-							self.__seek__(self.action_tree[i][j][k]["points_at"])
-							for l in range(self.action_tree[i][j][k]["entries"]):
-								
-								self.__pack__(self.action_tree[i][j][k][l]["vals"][0], 2)
-								self.__pack__(self.action_tree[i][j][k][l]["vals"][1], 2)
-								self.__pack__(self.action_tree[i][j][k][l]["vals"][2], 2)
-								self.__pack__(self.action_tree[i][j][k][l]["vals"][3], 2)
-								self.__pack__(self.action_tree[i][j][k][l]["vals"][4], 2)
+			for k in type3:
 
+				self.__seek__(k.points_at)
+				for l in k.children:
+					self.__write__(self.t4_struct.pack(*l.raw))
 
 		def get_name(self):
 			return "XLS"
 
+		def __state__(self):
+
+			#Flatten the tree into (key, level, offset, values, child count) tuples.
+			self.__normalise__()
+			flat = []
+			for i in self.action_tree:
+				pending = [(i, self.action_tree[i])]
+				while (pending):
+					key, e = pending.pop()
+					children = e.children if (e.children is not None) else []
+					flat.append((key, e.level, e.points_at, tuple(e.raw) if (e.raw is not None) else None, len(children)))
+					pending += [((key, n), c) for n, c in enumerate(children)]
+
+			return [marshal.dumps((self.header_entry_length, flat))]
+
 	#Passes tests;
 	#All fields identified.
 	class AMF_section(dlcsection):
@@ -910,75 +1305,272 @@ class dlc(object):
 		a18_header = "\x00\xff\x00\xffGENERALPLUS SP\x00\x00"
 		samplerate = 16000
 
+		#A track that's still sitting in a file (e.g. an a18 being imported),
+		#which is only read when it's needed. Like the tracks parsed from a
+		#DLC, it can be measured with len(), sliced, and converted with str().
+		class track_ref(object):
+
+			__slots__ = ("path", "offset", "length", "stamp", "digest")
+
+			block_size = 0x10000
+
+			#digest is the SHA-1 of the track, if it's already known.
+			#The path is made absolute, as the track isn't read until the DLC
+			#is built, by which time the working directory may have changed.
+			def __init__(self, path, offset, length, digest=None):
+
+				self.path = os.path.realpath(path)
+				self.offset = offset
+				self.length = length
+				self.stamp = self.__stamp__()
+				self.digest = digest
+
+			def __stamp__(self):
+
+				st = os.stat(self.path)
+				return (st.st_mtime, st.st_size)
+
+			def __len__(self):
+				return self.length
+
+			def __getitem__(self, key):
+
+				if (isinstance(key, slice)):
+					start, stop, step = key.indices(self.length)
+					if (step == 1):
+						return self.read(start, stop - start)
+
+				return str(self)[key]
+
+			def __str__(self):
+				return self.read(0, self.length)
+
+			def key(self):
+				return (self.path, self.offset, self.length, self.stamp)
+
+			def read(self, start, numbytes):
+
+				if (self.__stamp__() != self.stamp):
+					raise FormatError("Track file %s has changed since it was added." % self.path)
+
+				with open(self.path, "rb") as f:
+					f.seek(self.offset + start)
+					return f.read(max(0, numbytes))
+
+			#The track's bytes, a block at a time.
+			def blocks(self):
+
+				for start in range(0, self.length, self.block_size):
+					yield self.read(start, min(self.block_size, self.length - start))
+
+			def write_to(self, target):
+
+				for block in self.blocks():
+					target.write(block)
+
+		#Remembers the a18 files that have been imported, so that importing
+		#the same file again (into another slot, or another DLC) doesn't mean
+		#opening, sniffing and hashing it all over again. Files are known by
+		#path, mtime and size, and tracks by the SHA-1 of their (header-less)
+		#bytes, so identical tracks from different files are only kept once.
+		#Give it a directory to keep the tracks on disk as well, where other
+		#processes using the same directory can find them.
+		class track_cache(object):
+
+			def __init__(self, directory=None):
+
+				self.directory = os.path.realpath(directory) if (directory is not None) else None
+				if ((directory is not None) and (not os.path.isdir(directory))):
+					os.makedirs(directory)
+
+				self.clear()
+
+			def clear(self):
+
+				self.files = {}		# (path, mtime, size) : (track path, offset, length, digest)
+				self.tracks = {}	# digest : track bytes, once they've been asked for
+				self.hits = 0
+				self.misses = 0
+
+			def stats(self):
+				return {"hits" : self.hits, "misses" : self.misses, "files" : len(self.files), "tracks" : len(self.tracks)}
+
+			#A track_ref to the track in an a18 file.
+			def ref(self, trackpath):
+
+				#Entries hold the real path too, so they work from any working directory.
+				trackpath = os.path.realpath(trackpath)
+				st = os.stat(trackpath)
+				key = (trackpath, st.st_mtime, st.st_size)
+
+				if (key in self.files):
+					self.hits += 1
+				else:
+					found = self.__load__(key)
+					if (found is not None):
+						self.hits += 1
+					else:
+						self.misses += 1
+						found = self.__read_track__(trackpath, key)
+					self.files[key] = found
+
+				path, offset, length, digest = self.files[key]
+				return dlc.AMF_section.track_ref(path, offset, length, digest)
+
+			#The track's bytes. Every caller gets the same string.
+			def get(self, trackpath):
+
+				ref = self.ref(trackpath)
+				if (ref.digest not in self.tracks):
+					self.tracks[ref.digest] = str(ref)
+				return self.tracks[ref.digest]
+
+			def __path__(self, name):
+				return os.path.join(self.directory, name)
+
+			def __keyfile__(self, key):
+				return self.__path__(hashlib.sha1(repr(key)).hexdigest() + ".key")
+
+			def __load__(self, key):
+
+				if (self.directory is None):
+					return None
+
+				try:
+					with open(self.__keyfile__(key), "rb") as f:
+						digest = f.read()
+					trackfile = self.__path__(digest + ".a18")
+					return (trackfile, 0, os.path.getsize(trackfile), digest.decode("hex"))
+				except (IOError, OSError):
+					return None
+
+			def __read_track__(self, trackpath, key):
+
+				with open(trackpath, "rb") as f:
+					filebytes = f.read()
+
+				#Check for generalplus header; skip it if found.
+				offset = 0x30 if (filebytes.startswith(dlc.AMF_section.a18_header)) else 0x00
+				filelength = struct.unpack_from("<I", filebytes, offset)[0]
+				track = filebytes[offset : offset + 4 + filelength]
+				digest = hashlib.sha1(track).digest()
+
+				if (self.directory is None):
+					return (trackpath, offset, len(track), digest)
+
+				trackfile = self.__path__(digest.encode("hex") + ".a18")
+				if (not os.path.exists(trackfile)):
+					self.__store__(trackfile, track)
+				self.__store__(self.__keyfile__(key), digest.encode("hex"))
+
+				return (trackfile, 0, len(track), digest)
+
+			#Writes then renames, so that nothing else ever sees half a file.
+			def __store__(self, path, data):
+
+				temp_path = "%s.%d.tmp" % (path, os.getpid())
+				with open(temp_path, "wb") as f:
+					f.write(data)
+				os.rename(temp_path, path)
+
+		#Shared by every AMF section in this process.
+		import_cache = track_cache()
+
 		def __initialise__(self):
 			self.tracks = []
 
 			#If this section has been initialised with a non-zero string
 			#of bytes, attempt to parse it.
-			if (self.rawbytes != ""):
+			if (self.length > 0):
 
 				#Get the number of tracks contained in't.
 				track_count = self.__unpack__(4)
 
 				#Get track offsets.
-				track_offsets = []
-				for _ in range(track_count):
-					track_offsets.append(self.__unpack__(4))
+				track_offsets = self.__unpack_many__(track_count, 4)
 
-				#Get tracks.
+				#Get tracks. (These are views onto the section's bytes, not copies.)
 				for track_offset in track_offsets:
 					self.__seek__(track_offset)
 					
-					lengthbytes = self.__read__(4)
-					length = struct.unpack("<I", lengthbytes)[0]
-					audiobytes = self.__read__(length)
-					self.tracks.append(lengthbytes + audiobytes)	
+					length = self.__unpack__(4)
+					self.tracks.append(self.view(track_offset, 4 + length))
+
+		#Tracks are views as well: an unchanged section re-reads them from
+		#its private copy, otherwise any that are still views get copied.
+		def __detach__(self):
+
+			clean = not self.is_dirty()
+			dlc.dlcsection.__detach__(self)
+			if (clean):
+				self.__initialise__()
+				self.__seek__(0)
+			else:
+				self.tracks = [(bytes(t) if (type(t) == buffer) else t) for t in self.tracks]
 
 		def __compile__(self):
 			
 			#Initialise.
-			self.rawbytes = ""
-			self.__seek__(0)
+			self.rawbytes = self.__offset_table__()
+			self.__seek__(self.length)
+
+			#Lastly, write out the tracks proper.
+			for t in self.tracks:
+				self.__write__(str(t) if (type(t) == self.track_ref) else t)
+
+		#The "number of entries" dword, followed by the offset to each track;
+		#this only depends on the tracks' lengths.
+		def __offset_table__(self):
 
-			#Start with the "number of entries" dword.
-			self.__pack__(len(self.tracks), 4)
-			
 			#work out offset to first track
 			offset_to_next_track = 4 * (1 + len(self.tracks))
-			
-			#section header: write offsets to each track.
+
+			offsets = []
 			for t in self.tracks:
-				
-				self.__pack__(offset_to_next_track, 4)
+				offsets.append(offset_to_next_track)
 				offset_to_next_track += len(t)
 
-			#Lastly, write out the tracks proper.
-			for t in self.tracks:
-				self.__write__(t)
+			return struct.pack("<%dI" % (1 + len(offsets)), len(offsets), *offsets)
+
+		#Tracks are written out straight from wherever they live, rather than
+		#assembling the whole section in memory just to build a DLC.
+		def __chunks__(self):
+
+			if (not self.is_dirty()):
+				return [self.view()]
+			return [self.__offset_table__()] + self.tracks
 
 		def get_name(self):
 			return "AMF"
 
-		def __get_track__(self, trackpath):
+		def __state__(self):
+			return [marshal.dumps([len(t) for t in self.tracks])] + [(marshal.dumps(t.key()) if (type(t) == self.track_ref) else t) for t in self.tracks]
 
-			with open(trackpath, "r") as f:
+		#SHA-1 of a track's bytes, read in blocks if it's still in a file.
+		def track_digest(self, track_number):
 
-				#Check for generalplus header; remove if found.
-				firstbytes = f.read(len(self.a18_header))
-				if (firstbytes == self.a18_header):
-					f.seek(0x30)
-				else:
-					f.seek(0x00)
+			t = self.tracks[track_number]
+			h = hashlib.sha1()
+			if (type(t) == self.track_ref):
+				if (t.digest is not None):
+					return t.digest
+				for block in t.blocks():
+					h.update(block)
+			else:
+				h.update(t)
+			return h.digest()
 
-				lengthbytes = f.read(4)
-				filelength = struct.unpack("<I", lengthbytes)[0]
-				audiobytes = f.read(filelength)
+		#Refers to the track in an a18 file, without keeping it in memory.
+		def __track_ref__(self, trackpath):
+			return self.import_cache.ref(trackpath)
 
-			return lengthbytes + audiobytes
+		def __get_track__(self, trackpath):
+			return self.import_cache.get(trackpath)
 
+		#New tracks are kept as references to their files until the DLC is built.
 		def add_track(self, trackpath, pos=None):
 
-			newbytes = self.__get_track__(trackpath)
+			newbytes = self.__track_ref__(trackpath)
 
 			if (pos is None):
 				self.tracks.append(newbytes)
@@ -1038,7 +1630,7 @@ class dlc(object):
 
 			#If this section has been initialised with a non-zero string
 			#of bytes, attempt to parse it.
-			if (self.rawbytes != ""):
+			if (self.length > 0):
 
 				#Get the number of playlists contained in't.
 				playlist_count = self.__unpack__(2)
@@ -1051,7 +1643,7 @@ class dlc(object):
 				self.header_entry_length = self.__unpack__(4)
 
 				#Get playlist offsets.
-				playlist_offsets = [(2 * self.__unpack__(4)) for _ in range(playlist_count)]
+				playlist_offsets = [(2 * o) for o in self.__unpack_many__(playlist_count, 4)]
 
 				#Make categorizer.
 				cat = lambda w: (w, "EOF") if (w == self.entry_terminator) else (w, "PAUSE") if (w & 0x1000 == 0x1000) else (w, "AUDIO")
@@ -1061,10 +1653,7 @@ class dlc(object):
 
 					self.__seek__(playlist_offset)
 
-					this_playlist = [cat(self.__unpack__(2))]
-					
-					while (this_playlist[-1][1] != "EOF"):
-						this_playlist.append(cat(self.__unpack__(2)))
+					this_playlist = [cat(w) for w in self.__unpack_until__(self.entry_terminator, 2)]
 
 					self.playlists.append(this_playlist)
 
@@ -1100,6 +1689,9 @@ class dlc(object):
 		def get_name(self):
 			return "APL"
 
+		def __state__(self):
+			return [marshal.dumps((self.header_entry_length, self.playlists))]
+
 		def add_playlist(self, pl_in):
 			
 			#verify.
@@ -1136,7 +1728,7 @@ class dlc(object):
 			self.phrases = []
 			self.header_entry_length = self.default_header_entry_length
 			
-			if (self.rawbytes != ""):
+			if (self.length > 0):
 
 				#Get the number of phrases contained in't.
 				phrase_count = self.__unpack__(2)
@@ -1145,7 +1737,7 @@ class dlc(object):
 				self.header_entry_length = self.__unpack__(4)
 
 				#Get phrase offsets.
-				phrase_offsets = [(2 * (3 + self.__unpack__(4))) for _ in range(phrase_count)]
+				phrase_offsets = [(2 * (3 + o)) for o in self.__unpack_many__(phrase_count, 4)]
 				
 				#Check for terminator.
 				assert(self.__unpack__(4) == self.header_terminator)
@@ -1154,10 +1746,7 @@ class dlc(object):
 				for phrase_o in phrase_offsets:
 
 					self.__seek__(phrase_o)
-					this_phrase = [self.__unpack__(2)]
-					
-					while (this_phrase[-1] != self.entry_terminator):
-						this_phrase.append(self.__unpack__(2))
+					this_phrase = self.__unpack_until__(self.entry_terminator, 2)
 				
 					self.phrases.append(this_phrase)
 
@@ -1193,6 +1782,9 @@ class dlc(object):
 		def get_name(self):
 			return "LPS"
 
+		def __state__(self):
+			return [marshal.dumps((self.header_entry_length, self.phrases))]
+
 	#Passes tests,
 	#need to deconstruct SEQ entries tho
 	class SEQ_section(dlcsection):
@@ -1201,6 +1793,9 @@ class dlc(object):
 		entry_terminator = 0
 		
 		playlist_offset = 0x4546
+		mtr_offset = 0xc400		# 0xc4xx picks an MTR entry; 0xexxx are built into the furby
+		eye_animation_nibbles = (0x08, 0x0a)
+		custom_eye_animation = 0x8400	# 0x84xx plays the DLC's own SPR animations
 
 		def __initialise__(self):
 			self.sequences = []
@@ -1208,7 +1803,7 @@ class dlc(object):
 
 			#If this section has been initialised with a non-zero string
 			#of bytes, attempt to parse it.
-			if (self.rawbytes != ""):
+			if (self.length > 0):
 
 				#Get the number of sequences contained in't.
 				seq_count = self.__unpack__(2)
@@ -1217,20 +1812,18 @@ class dlc(object):
 				self.header_entry_length = self.__unpack__(4)
 
 				#Get sequence offsets.
-				seq_offsets = [(2 * self.__unpack__(4)) for _ in range(seq_count)]
+				seq_offsets = [(2 * o) for o in self.__unpack_many__(seq_count, 4)]
 
 				#Get sequences.
 				for seq_o in seq_offsets:
 
 					self.__seek__(seq_o)
-					this_sequence = [self.__unpack__(2)]
-					
+
 					#First word: 0x02 or 0x03
 					#Second word: Playlist select.
 					#Third word: MTR select (or pick one of the actions pre-programmed on the furby; first nibble determines which)
 					#Fourth -> (n-1)th word: Eye animation select. Every second word indicates inter-animation delay.
-					while (this_sequence[-1] != self.entry_terminator):
-						this_sequence.append(self.__unpack__(2))
+					this_sequence = self.__unpack_until__(self.entry_terminator, 2)
 				
 					self.sequences.append(this_sequence)
 
@@ -1263,6 +1856,9 @@ class dlc(object):
 		def get_name(self):
 			return "SEQ"
 
+		def __state__(self):
+			return [marshal.dumps((self.header_entry_length, self.sequences))]
+
 	#Passes tests,
 	#need to deconstruct MTR entries tho
 	class MTR_section(dlcsection):
@@ -1275,7 +1871,7 @@ class dlc(object):
 			self.animations = []
 			self.header_entry_length = self.default_header_entry_length
 			
-			if (self.rawbytes != ""):
+			if (self.length > 0):
 
 				#Get the number of animations contained in't.
 				anim_count = self.__unpack__(2)
@@ -1284,16 +1880,13 @@ class dlc(object):
 				self.header_entry_length = self.__unpack__(4)
 
 				#Get animation offsets.
-				anim_offsets = [(2 * (3 + self.__unpack__(4))) for _ in range(anim_count)]
+				anim_offsets = [(2 * (3 + o)) for o in self.__unpack_many__(anim_count, 4)]
 
 				#Get animations.
 				for anim_o in anim_offsets:
 
 					self.__seek__(anim_o)
-					this_anim = [self.__unpack__(2)]
-					
-					while (this_anim[-1] != self.entry_terminator):
-						this_anim.append(self.__unpack__(2))
+					this_anim = self.__unpack_until__(self.entry_terminator, 2)
 				
 					self.animations.append(this_anim)
 
@@ -1326,129 +1919,713 @@ class dlc(object):
 		def get_name(self):
 			return "MTR"
 
+		def __state__(self):
+			return [marshal.dumps((self.header_entry_length, self.animations))]
+
+	#Section name -> class used to parse it.
+	section_generators = {
+		"PAL"   	:	PAL_section,
+		"SPR"   	:	SPR_section,
+		"CEL"   	:	CEL_section,
+		"XLS"   	:	XLS_section,
+		"AMF"   	:	AMF_section,
+		"APL"   	:	APL_section,
+		"LPS"   	:	LPS_section,
+		"SEQ"   	:	SEQ_section,
+		"MTR"   	:	MTR_section,
+	}
+
+	#Behaves like the dict of sections it replaces, but only parses
+	#a section the first time it's looked up.
+	class lazy_sections(collections.MutableMapping):
+
+		def __init__(self, source=None, filemap=None):
+
+			#source holds the bytes of the whole DLC;
+			#filemap maps section names to (offset, length) within it.
+			self.source = source
+			self.unparsed = {}
+			self.parsed = {}
+
+			if (filemap is not None):
+				for sec, (o, l) in filemap.items():
+					self.set_raw(sec, buffer(source, o, l))
+			self.__release__()
+
+		def __getitem__(self, sec):
+
+			if ((sec not in self.parsed) and (sec in self.unparsed)):
+				self.parsed[sec] = dlc.section_generators[sec](self.raw_section(sec))
+				del self.unparsed[sec]
+				self.__release__()
+
+			return self.parsed[sec]
+
+		def __setitem__(self, sec, section_in):
+
+			self.unparsed.pop(sec, None)
+			self.parsed[sec] = section_in
+			self.__release__()
+
+		def __delitem__(self, sec):
+
+			if (sec not in self):
+				raise KeyError(sec)
+			self.unparsed.pop(sec, None)
+			self.parsed.pop(sec, None)
+			self.__release__()
+
+		#Once every section has been parsed, source isn't needed any more.
+		#(A mmap is only unmapped once nothing views it, including sections
+		#that haven't been written to yet; see dlc.close().)
+		def __release__(self):
+
+			if (not self.unparsed):
+				self.source = None
+
+		#Copies everything still viewed from source, and lets go of it.
+		def detach(self):
+
+			for sec in self.unparsed:
+				self.unparsed[sec] = buffer(bytes(self.unparsed[sec]))
+			for sec in self.parsed:
+				self.parsed[sec].__detach__()
+			self.source = None
+
+		def __contains__(self, sec):
+			return ((sec in self.parsed) or (sec in self.unparsed))
+
+		def __iter__(self):
+			return iter(list(self.parsed) + list(self.unparsed))
+
+		def __len__(self):
+			return len(self.parsed) + len(self.unparsed)
+
+		def is_parsed(self, sec):
+			return (sec in self.parsed)
+
+		#The original bytes of a section that hasn't been parsed yet
+		#(a read-only view into source, not a copy.)
+		def raw_section(self, sec):
+			return self.unparsed[sec]
+
+		#Replaces a section with bytes to be parsed when it's first used.
+		def set_raw(self, sec, bytes_in):
+
+			self.parsed.pop(sec, None)
+			self.unparsed[sec] = bytes_in
+
+	#Records which parts of a DLC refer to which. Nodes are (kind, number)
+	#tuples, e.g. ("action", (75,0,0,0)), ("seq", 16), ("track", 138),
+	#("frame", 40), ("cel", 17) or ("palette", <palette offset>).
+	class reference_graph(object):
+
+		def __init__(self):
+			self.refers_to = collections.defaultdict(set)
+			self.referred_by = collections.defaultdict(set)
+
+		def add_node(self, node):
+			self.refers_to[node]
+			self.referred_by[node]
+
+		def add(self, node_from, node_to):
+			self.refers_to[node_from].add(node_to)
+			self.referred_by[node_to].add(node_from)
+			self.referred_by[node_from]
+			self.refers_to[node_to]
+
+		def nodes(self, kind=None):
+			return set(n for n in self.refers_to if ((kind is None) or (n[0] == kind)))
+
+		#Direct references, in either direction.
+		def references(self, node):
+			return set(self.refers_to.get(node, ()))
+
+		def referrers(self, node):
+			return set(self.referred_by.get(node, ()))
+
+		#Everything reachable from nodes (following references backwards
+		#if reverse is set), optionally only of one kind.
+		def reachable(self, nodes, reverse=False, kind=None):
+
+			edges = self.referred_by if reverse else self.refers_to
+			seen = set()
+			pending = list(nodes)
+			while (pending):
+				n = pending.pop()
+				if n not in seen:
+					seen.add(n)
+					pending.extend(edges.get(n, ()))
+
+			return set(n for n in seen if ((kind is None) or (n[0] == kind)))
+
+		#e.g. actions_reaching(("track", 138)) or actions_reaching(("cel", 17))
+		def actions_reaching(self, node):
+			return set(n[1] for n in self.reachable([node], reverse=True, kind="action"))
+
+		#Nodes of a kind that can't be reached from any action code.
+		def unreferenced(self, kind):
+			return self.nodes(kind) - self.reachable(self.nodes("action"), kind=kind)
+
 	#Creates the class.
 	#Also includes a self-test - to run it, just set self_test to something.
-	def __init__(self, filepath_in=None, self_test=None):
+	#Set use_mmap to map the file rather than reading it in; sections then
+	#stay as views into the mapping until they're modified.
+	def __init__(self, filepath_in=None, self_test=None, use_mmap=False):
 
 		self.dlc_header = None
-		self.dlc_sections = {}
+		self.dlc_sections = self.lazy_sections()
+		self.resolved_actions = None
+		self.resolved_from = None
 
 		if filepath_in is not None:
 
-			with open(filepath_in, "r") as f:
+			with open(filepath_in, "rb") as f:
+				if (use_mmap):
+					source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+				else:
+					source = f.read()
 
-				#Parse header.
-				self.dlc_header = self.HEADER_section(f.read(0x288))
+			#Parse header.
+			self.dlc_header = self.HEADER_section(source[:0x288])
 
-				#Map sections
-				section_map = self.dlc_header.map_dlc()
+			#Map sections; they get parsed as and when they're used.
+			filemap = { e[0] : (e[2], e[1]) for e in self.dlc_header.map_dlc() }
+			self.dlc_sections = self.lazy_sections(source, filemap)
 
-				filemap = { e[0] : {"l" : e[1], "o" : e[2]} for e in section_map}
-				
-				#Generate section objects.
-				section_generators = {
-					"PAL"   	:	self.PAL_section,
-					"SPR"   	:	self.SPR_section,
-					"CEL"   	:	self.CEL_section,
-					"XLS"   	:	self.XLS_section,
-					"AMF"   	:	self.AMF_section,
-					"APL"   	:	self.APL_section,
-					"LPS"   	:	self.LPS_section,
-					"SEQ"   	:	self.SEQ_section,
-					"MTR"   	:	self.MTR_section,
-				}
+			if (self_test is not None):
 
 				for sec in filemap:
 
-					f.seek(filemap[sec]["o"])
-					rawbytes = f.read(filemap[sec]["l"])
+					rawbytes = bytes(self.dlc_sections.raw_section(sec))
+					d = self.dlc_sections[sec]
+
+					print "testing %s at offset %d" % (sec, filemap[sec][0])
+					newbytes = d.write_out(force=True)
+					try:
+						print(len(rawbytes) == len(newbytes))
+						assert(rawbytes == newbytes)
+					except:
+						i=0
+						for i in range(min(len(rawbytes), len(newbytes))):
+							if rawbytes[i] != newbytes[i]:
+								break
+						raise AssertionError("Test failed: error at offset 0x%x\n\texpected %02x, got %02x" % (i, ord(rawbytes[i]), ord(newbytes[i]) ))
+					else:
+						print "\tTest Successful!"
+
+	#Lets go of a mmapped DLC file, copying whatever's still read from it
+	#into memory first, so this DLC keeps working afterwards. The mapping
+	#itself goes once nothing else (e.g. a fork()) is viewing it.
+	def close(self):
+		self.dlc_sections.detach()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	#Returns a lightweight copy of this DLC, for building variants of it.
+	#Sections are shared with this one as read-only compiled bytes, so the
+	#fork only parses (and recompiles) the sections it actually changes;
+	#everything else is copied straight from this DLC at build time.
+	#Changes made to this DLC after forking don't affect the fork, or vice versa.
+	def fork(self):
+
+		D = dlc()
+
+		#A DLC put together from scratch has no header yet; build() makes one anyway.
+		if (self.dlc_header is not None):
+			D.dlc_header = self.HEADER_section(self.dlc_header.__freeze__())
+		else:
+			D.dlc_header = self.HEADER_section()
+		D.dlc_sections = self.lazy_sections(self.dlc_sections.source)
 
-					d = section_generators[sec](rawbytes)
-					
-					self.dlc_sections[sec] = d
-					
-					if (self_test is not None):
-
-						print "testing %s at offset %d" % (sec, filemap[sec]["o"])
-						newbytes = d.write_out()
-						try:
-							print(len(rawbytes) == len(newbytes))
-							assert(rawbytes == newbytes)
-						except:
-							i=0
-							for i in range(min(len(rawbytes), len(newbytes))):
-								if rawbytes[i] != newbytes[i]:
-									break
-							raise AssertionError("Test failed: error at offset 0x%x\n\texpected %02x, got %02x" % (i, ord(rawbytes[i]), ord(newbytes[i]) ))
-						else:
-							print "\tTest Successful!"
+		for sec in self.dlc_sections:
+			if (self.dlc_sections.is_parsed(sec)):
+				self.dlc_sections[sec].__recompile__()
+				D.dlc_sections.set_raw(sec, self.dlc_sections[sec].__freeze__())
+			else:
+				D.dlc_sections.set_raw(sec, self.dlc_sections.raw_section(sec))
 
-	#Builds a new DLC.
-	def build(self, filepath_in):
+		return D
+
+	#Compiles (where needed) every section we'd like to include, exactly once,
+	#and re-generates the header from their lengths.
+	#Returns the whole DLC as a list of read-only buffers (or AMF track_refs,
+	#which know how to write themselves out), header first.
+	def __generate__(self):
 
-		#Generate each of the sections we'd like to include.
-		#Also re-generate the header as we go.
 		self.dlc_header.registered_fields = {}
-		generated_sections = {}
+		chunks = []
 		for sec in self.dlc_header.header_fields:
 			if sec in self.dlc_sections:
-				generated_sections[sec] = self.dlc_sections[sec].write_out()
-				self.dlc_header.register_section(sec, len(generated_sections[sec]))
+				section_chunks = self.__section_chunks__(sec)
+				self.dlc_header.register_section(sec, sum(len(c) for c in section_chunks))
+				chunks.extend(section_chunks)
 
-		#Open the file.
-		with open(filepath_in, "w") as f:
+		self.dlc_header.__recompile__()
+		return [self.dlc_header.view()] + chunks
 
-			#Write header.
-			f.write(self.dlc_header.write_out())
-			
-			#Try to write out each section.
-			for sec in self.dlc_header.header_fields:
-				if sec in self.dlc_sections:
-					f.write(self.dlc_sections[sec].write_out())
+	def __section_chunks__(self, sec):
 
-	def draw_cel(self, cel_number, pal_number, outfile):
+		#Sections that haven't changed since they were read are copied across as-is.
+		if (self.dlc_sections.is_parsed(sec)):
+			return self.dlc_sections[sec].__chunks__()
+		return [self.dlc_sections.raw_section(sec)]
 
-		target_cel = self.dlc_sections["CEL"].cels[cel_number]
-		target_palette = self.dlc_sections["PAL"].palettes[pal_number]
-		
-		w = self.dlc_sections["CEL"].cel_width
-		h = self.dlc_sections["CEL"].cel_height
-		
-		im = PILImage.new("RGBA", (w, h))
+	#The size build() would write, without building anything.
+	def built_size(self):
 
-		for y in range(h):
-			for x in range(w):
-				
-				col_index = target_cel[y][x]
-				
-				true_col = target_palette[col_index]
+		size = self.dlc_header.main_header_length
+		for sec in self.dlc_header.header_fields:
+			if sec in self.dlc_sections:
+				size += sum(len(c) for c in self.__section_chunks__(sec))
+		return size
+
+	#Builds a new DLC.
+	#target can be a path, or anything with a write() method.
+	def build(self, target):
 
-				im.putpixel((x,y), true_col)
+		chunks = self.__generate__()
+
+		#Write the header and each section in turn.
+		#Paths are written via a temporary file that then replaces the target,
+		#as unparsed sections are still read from the source DLC (which may be
+		#mapped) while we write, and the target may well be that same file.
+		if (isinstance(target, basestring)):
+			temp_path = "%s.%d.tmp" % (target, os.getpid())
+			try:
+				with open(temp_path, "wb") as f:
+					self.__write_chunks__(chunks, f)
+				if (os.name == "nt" and os.path.exists(target)):
+					os.remove(target)
+				os.rename(temp_path, target)
+			finally:
+				if (os.path.exists(temp_path)):
+					os.remove(temp_path)
+		else:
+			self.__write_chunks__(chunks, target)
+
+	def __write_chunks__(self, chunks, target):
+
+		for chunk in chunks:
+			if (type(chunk) == self.AMF_section.track_ref):
+				chunk.write_to(target)
+			else:
+				target.write(chunk)
+
+	#Builds a new DLC, and returns it as a string rather than writing it anywhere.
+	def build_bytes(self):
+
+		out = io.BytesIO()
+		self.build(out)
+		return out.getvalue()
+
+	#Returns the image; also saves it if outfile is given.
+	def draw_cel(self, cel_number, pal_number, outfile=None, indexed=False):
+
+		target_palette = self.dlc_sections["PAL"].palettes[pal_number]
+		im = self.dlc_sections["CEL"].render_cel(cel_number, target_palette, indexed)
 
 		#Use PNGs to preserve transparency.
-		im.save(outfile, format="PNG")
+		if (outfile is not None):
+			im.save(outfile, format="PNG")
+		return im
+
+	#palette_number can also be a list of palettes, in which case stub needs a
+	#second field for the palette number (e.g. "./cel%04d_%02d.png").
+	#Set processes to spread the work over that many worker processes
+	#(None for one per core.) Returns some throughput stats.
+	def dump_cels(self, palette_number, stub="./cel%04d.png", processes=1, chunksize=8):
 
-	def dump_cels(self, palette_number, stub="./cel%04d.png"):
+		num_cels = len(self.dlc_sections["CEL"].cels)
+
+		if (isinstance(palette_number, (list, tuple))):
+			tasks = [(c, p, (stub % (c, p))) for p in palette_number for c in range(num_cels)]
+		else:
+			tasks = [(c, palette_number, (stub % c)) for c in range(num_cels)]
+
+		return self.__dump__(tasks, processes, chunksize)
+
+	def dump_cels_monochrome(self, stub="./cel%04d.png", processes=1, chunksize=8):
+
+		return self.dump_cels(1, stub, processes, chunksize)
+
+	#tasks is a list of (cel number, palette number, filename).
+	def __dump__(self, tasks, processes=1, chunksize=8):
+
+		started = time.time()
+
+		if (processes == 1):
+			for c, p, filename in tasks:
+				self.draw_cel(c, p, filename)
+
+		else:
+			#The cels and palettes go to each worker once, up front;
+			#tasks only carry numbers and filenames.
+			initargs = (self.dlc_sections["CEL"].cel_array, self.dlc_sections["PAL"].palettes)
+			pool = multiprocessing.Pool(processes, dump_worker_init, initargs)
+			try:
+				for _ in pool.imap_unordered(dump_worker, tasks, chunksize):
+					pass
+			finally:
+				pool.close()
+				pool.join()
 
-		for p in range(len(self.dlc_sections["CEL"].cels)):
+		elapsed = time.time() - started
 
-			self.draw_cel(p, palette_number, (stub % p))
+		return {
+			"images"		:	len(tasks),
+			"seconds"		:	elapsed,
+			"images_per_second"	:	(len(tasks) / elapsed) if (elapsed > 0) else 0,
+		}
 
-	def dump_cels_monochrome(self, stub="./cel%04d.png"):
 
-		for p in range(len(self.dlc_sections["CEL"].cels)):
+	#As CEL_section.import_gif(), but also moves SPR frames' references to
+	#any cels at or after pos along, past the new ones.
+	def import_gif(self, filename_in, pos=None):
 
-			self.draw_cel(p, 1, (stub % p))
+		new_cels = self.dlc_sections["CEL"].import_gif(filename_in, pos)
 
+		if (len(new_cels) > 0):
+			first, count = new_cels[0], len(new_cels)
+			for f in self.dlc_sections["SPR"].frames:
+				f[0:8:2] = [(c + count) if (c >= first) else c for c in f[0:8:2]]
+
+		return new_cels
+
+	#Keeps one copy of each distinct cel, and points every SPR frame
+	#that used a duplicate at the surviving copy. Returns the number
+	#of bytes this saves in the CEL section.
+	def dedupe_cels(self):
+
+		cels = self.dlc_sections["CEL"].cel_array
+
+		first_copy = {}
+		keep = []
+		renumber = []
+		for i in range(len(cels)):
+			key = cels[i].tobytes()
+			if key not in first_copy:
+				first_copy[key] = len(keep)
+				keep.append(i)
+			renumber.append(first_copy[key])
+
+		self.__keep_cels__(keep, renumber)
+
+		return (len(cels) - len(keep)) * self.dlc_sections["CEL"].frame_length
+
+	#Keeps one copy of each distinct AMF track, and points every APL
+	#playlist entry that used a duplicate at the surviving copy.
+	#Returns the number of bytes this saves in the AMF section.
+	def dedupe_tracks(self):
+
+		tracks = self.dlc_sections["AMF"].tracks
+
+		first_copy = {}
+		keep = []
+		renumber = []
+		for i in range(len(tracks)):
+			key = self.dlc_sections["AMF"].track_digest(i)
+			if key not in first_copy:
+				first_copy[key] = len(keep)
+				keep.append(i)
+			renumber.append(first_copy[key])
+
+		saved = sum((4 + len(tracks[i])) for i in set(range(len(tracks))) - set(keep))
+		self.__keep_tracks__(keep, renumber)
+
+		return saved
+
+	#Keeps only the cels numbered in keep, pointing SPR frames at their new
+	#numbers; renumber maps every old cel number still in use to its new one.
+	def __keep_cels__(self, keep, renumber):
+
+		#Even words in each frame are cel numbers; odd ones are palette offsets.
+		for f in self.dlc_sections["SPR"].frames:
+			f[0:8:2] = [renumber[c] for c in f[0:8:2]]
+
+		self.dlc_sections["CEL"].cel_array = self.dlc_sections["CEL"].cel_array[keep]
+
+	#As __keep_cels__, for AMF tracks and the APL playlists that play them.
+	def __keep_tracks__(self, keep, renumber):
+
+		for pl in self.dlc_sections["APL"].playlists:
+			pl[:] = [((renumber[w], t) if (t == "AUDIO") else (w, t)) for w, t in pl]
+
+		tracks = self.dlc_sections["AMF"].tracks
+		self.dlc_sections["AMF"].tracks = [tracks[i] for i in keep]
+
+	#Works out what every action code in the XLS section leads to:
+	#{ action_code : {"seq", "playlist", "tracks", "eyes", "mtr"} }
+	#("mtr" is None if the sequence uses one of the furby's built-in motions.)
+	#The whole index is cached against the XLS, SEQ and APL sections'
+	#fingerprints, so it's only rebuilt once they've changed (pass
+	#refresh=True to rebuild it anyway.) Checking those costs a few ms, so
+	#for one action code at a time, use resolve_action() instead.
+	def action_index(self, refresh=False):
+
+		resolved_from = tuple(self.dlc_sections[sec].__fingerprint__() for sec in ("XLS", "SEQ", "APL"))
+
+		if ((self.resolved_actions is None) or (resolved_from != self.resolved_from) or refresh):
+
+			#Many action codes share a sequence, so resolve each sequence just once.
+			by_sequence = {}
+			for n in range(len(self.dlc_sections["SEQ"].sequences)):
+				by_sequence[n] = self.__resolve_sequence__(n)
+
+			self.resolved_actions = { code : by_sequence.get(leaf["seq"]) for code, leaf in self.dlc_sections["XLS"].build_leaf_index().items() }
+			self.resolved_from = resolved_from
+
+		return self.resolved_actions
+
+	#What one SEQ sequence leads to; None if there's no such sequence.
+	def __resolve_sequence__(self, n):
+
+		SEQ = self.dlc_sections["SEQ"]
+		playlists = self.dlc_sections["APL"].playlists
+
+		if not (0 <= n < len(SEQ.sequences)):
+			return None
+		seq = SEQ.sequences[n]
+
+		apl_no = seq[1] - SEQ.playlist_offset if (len(seq) > 1) else None
+		if (apl_no is not None) and (0 <= apl_no < len(playlists)):
+			tracks = tuple(w for w, t in playlists[apl_no] if t == "AUDIO")
+		else:
+			tracks = ()
+
+		mtr = seq[2] if (len(seq) > 2) else None
+		if (mtr is not None) and ((mtr & 0xff00) == SEQ.mtr_offset):
+			mtr -= SEQ.mtr_offset
+		else:
+			mtr = None
+
+		return {
+			"seq"		:	n,
+			"playlist"	:	apl_no,
+			"tracks"	:	tracks,
+			"eyes"		:	tuple(w for w in seq[3:-1] if (w >> 12) in SEQ.eye_animation_nibbles),
+			"mtr"		:	mtr,
+		}
+
+	#One action code, worked out from the sections as they are now
+	#(straight down XLS -> SEQ -> APL, without building the index.)
+	def resolve_action(self, action_code):
+		return self.__resolve_sequence__(self.dlc_sections["XLS"].lookup(action_code)["seq"])
+
+	#As above, for lots of action codes at once, using the cached index.
+	def resolve_actions(self, action_codes):
+
+		index = self.action_index()
+		return [index[tuple(a)] for a in action_codes]
+
+	#Builds a reference_graph of the whole DLC, in one pass over each section:
+	#XLS entries -> SEQ -> APL / MTR / eye animations -> SPR -> CEL / PAL.
+	def map_references(self):
+
+		graph = self.reference_graph()
+
+		XLS = self.dlc_sections["XLS"]
+		SEQ = self.dlc_sections["SEQ"]
+		APL = self.dlc_sections["APL"]
+		SPR = self.dlc_sections["SPR"]
+
+		for n in range(len(self.dlc_sections["AMF"].tracks)):
+			graph.add_node(("track", n))
+		for n in range(len(self.dlc_sections["MTR"].animations)):
+			graph.add_node(("mtr", n))
+		for n in range(len(self.dlc_sections["CEL"].cels)):
+			graph.add_node(("cel", n))
+
+		for code, leaf in XLS.build_leaf_index().items():
+			graph.add_node(("action", code))
+			if (leaf["seq"] < len(SEQ.sequences)):
+				graph.add(("action", code), ("seq", leaf["seq"]))
+
+		for n, seq in enumerate(SEQ.sequences):
+			graph.add_node(("seq", n))
+
+			if (len(seq) > 1) and (0 <= (seq[1] - SEQ.playlist_offset) < len(APL.playlists)):
+				graph.add(("seq", n), ("playlist", seq[1] - SEQ.playlist_offset))
+
+			if (len(seq) > 2) and ((seq[2] & 0xff00) == SEQ.mtr_offset):
+				graph.add(("seq", n), ("mtr", seq[2] - SEQ.mtr_offset))
+
+			for w in seq[3:-1]:
+				if ((w >> 12) in SEQ.eye_animation_nibbles):
+					graph.add(("seq", n), ("eyes", w))
+
+		for n, pl in enumerate(APL.playlists):
+			graph.add_node(("playlist", n))
+			for w, t in pl:
+				if (t == "AUDIO"):
+					graph.add(("playlist", n), ("track", w))
+
+		#Custom eye animations play the DLC's frame playlists.
+		for eyes in graph.nodes("eyes"):
+			if ((eyes[1] & 0xff00) == SEQ.custom_eye_animation):
+				for w in range(len(SPR.frame_playlists)):
+					graph.add(eyes, ("framelist", w))
+
+		for w, playlist in enumerate(SPR.frame_playlists):
+			graph.add_node(("framelist", w))
+			for f in playlist["frame_indices"]:
+				graph.add(("framelist", w), ("frame", f))
+
+		for f, frame in enumerate(SPR.frames):
+			graph.add_node(("frame", f))
+			for c in frame[0:8:2]:
+				graph.add(("frame", f), ("cel", c))
+			for p in frame[1:8:2]:
+				graph.add(("frame", f), ("palette", p))
+
+		return graph
+
+	#Gets rid of anything that can't be reached from the XLS action tree:
+	#unused AMF tracks and cels are removed (and references to them
+	#renumbered), unused SPR frames are compacted away, and unused APL
+	#playlists (with their LPS phrases), MTR animations and SEQ sequences
+	#are stubbed out so that the numbering of the rest stays put.
+	#Palettes are left alone, as frames refer to them by offset.
+	#Returns what was removed, and the size of the DLC before and after.
+	def gc(self):
+
+		bytes_before = self.built_size()
+		removed = {}
+
+		#We can't tell which built-in eye animations use the DLC's graphics,
+		#so every SPR frame playlist is kept. Identical frames aren't merged
+		#here, as later edits to one would show up in the other.
+		removed["frames"] = self.dlc_sections["SPR"].compact_frames(merge=False)
+
+		graph = self.map_references()
+		live = graph.reachable(graph.nodes("action") | graph.nodes("framelist"))
+
+		#Stub out unreachable entries.
+		stubs = {
+			"playlist"	:	(self.dlc_sections["APL"].playlists, [(self.APL_section.entry_terminator, "EOF")]),
+			"mtr"		:	(self.dlc_sections["MTR"].animations, [self.MTR_section.entry_terminator]),
+			"seq"		:	(self.dlc_sections["SEQ"].sequences, [self.SEQ_section.entry_terminator]),
+		}
+		for kind, (entries, stub) in stubs.items():
+			removed[kind] = 0
+			for n in range(len(entries)):
+				if ((kind, n) not in live) and (entries[n] != stub):
+					entries[n] = list(stub)
+					removed[kind] += 1
+
+					#LPS phrases go hand-in-hand with APL playlists.
+					if (kind == "playlist") and (len(self.dlc_sections["LPS"].phrases) == len(entries)):
+						self.dlc_sections["LPS"].phrases[n] = [self.LPS_section.entry_terminator]
+
+		#Remove unreachable tracks.
+		tracks = self.dlc_sections["AMF"].tracks
+		keep = [n for n in range(len(tracks)) if ("track", n) in live]
+		self.__keep_tracks__(keep, { n : i for i, n in enumerate(keep) })
+		removed["tracks"] = len(tracks) - len(keep)
+
+		#Remove unreachable cels.
+		cels = self.dlc_sections["CEL"].cel_array
+		keep = [n for n in range(len(cels)) if ("cel", n) in live]
+		self.__keep_cels__(keep, { n : i for i, n in enumerate(keep) })
+		removed["cels"] = len(cels) - len(keep)
+
+		return {
+			"removed"	:	removed,
+			"bytes_before"	:	bytes_before,
+			"bytes_after"	:	self.built_size(),
+		}
+
+	#Applies a declarative patch: a list of operations (or a dict with an
+	#"ops" list, or the path to a JSON file holding either), for example
+	#[
+	#	{"op" : "replace_track", "track" : 138, "file" : "./exterminate.a18"},
+	#	{"op" : "replace_audio", "action" : [75,0,0,0], "files" : ["./a.a18", "./b.a18"]},
+	#	{"op" : "replace_palette", "palette" : 4, "gif" : "./left.gif"},
+	#	{"op" : "import_gif", "gif" : "./left.gif", "pos" : 2},
+	#	{"op" : "set_sequence", "action" : [75,0,0,4], "words" : [0x3000, 0x4546, 0xe006, 0x8401]},
+	#	{"op" : "trigger_custom_graphics", "action" : [75,0,0,4]},
+	#	{"op" : "minify_audio", "length" : 128},
+	#	{"op" : "gc"},
+	#]
+	#The other ops are dedupe_cels, dedupe_tracks and compact_frames.
+	def apply_patch(self, patch):
+
+		if (isinstance(patch, basestring)):
+			with open(patch, "r") as f:
+				patch = json.load(f)
+
+		if (isinstance(patch, dict)):
+			patch = patch["ops"]
+
+		for op in patch:
+			handler = getattr(self, "__patch_%s__" % op["op"], None)
+			if (handler is None):
+				raise FormatError("Unknown patch operation %s" % op["op"])
+			handler(op)
+
+	def __patch_replace_track__(self, op):
+		self.dlc_sections["AMF"].replace_track(op["track"], op["file"])
+
+	def __patch_replace_audio__(self, op):
+		self.replace_audio(tuple(op["action"]), list(op["files"]))
+
+	def __patch_replace_palette__(self, op):
+
+		if ("gif" in op):
+			new_palette = self.dlc_sections["PAL"].extract_palette(op["gif"])
+		else:
+			new_palette = op["colours"]
+		self.dlc_sections["PAL"].palettes[op["palette"]] = new_palette
+
+	def __patch_import_gif__(self, op):
+		self.import_gif(op["gif"], op.get("pos"))
+
+	def __patch_set_sequence__(self, op):
+
+		SEQ = self.dlc_sections["SEQ"]
+
+		if ("action" in op):
+			sequence_no = self.dlc_sections["XLS"].lookup(op["action"])["seq"]
+		else:
+			sequence_no = op["seq"]
+
+		words = list(op["words"])
+		if ((len(words) == 0) or (words[-1] != SEQ.entry_terminator)):
+			words.append(SEQ.entry_terminator)
+
+		SEQ.sequences[sequence_no] = words
+
+	def __patch_trigger_custom_graphics__(self, op):
+		self.trigger_custom_graphics(tuple(op["action"]))
+
+	def __patch_minify_audio__(self, op):
+		self.dlc_sections["AMF"].minify_audio(op.get("length", 128))
+
+	def __patch_dedupe_cels__(self, op):
+		self.dedupe_cels()
+
+	def __patch_dedupe_tracks__(self, op):
+		self.dedupe_tracks()
+
+	def __patch_compact_frames__(self, op):
+		self.dlc_sections["SPR"].compact_frames()
+
+	def __patch_gc__(self, op):
+		self.gc()
 
 	def replace_audio(self, action_code, audio_files):
 
 		assert((type(action_code) == tuple) and (len(action_code) == 4))
 
-		sequence_no = self.dlc_sections["XLS"].action_tree[action_code[0]][action_code[1]][action_code[2]][action_code[3]]["seq"]
-		apl_no = self.dlc_sections["SEQ"].sequences[sequence_no][1] - self.dlc_sections["SEQ"].playlist_offset
+		resolved = self.resolve_action(action_code)
+		if ((resolved is None) or (resolved["playlist"] is None) or not (0 <= resolved["playlist"] < len(self.dlc_sections["APL"].playlists))):
+			raise IndexError("Action code %s doesn't lead to an APL playlist." % (action_code,))
 
-		amf_numbers = [i[0] for i in self.dlc_sections["APL"].playlists[apl_no] if i[1] == "AUDIO"]
+		amf_numbers = list(resolved["tracks"])
 
 		delta = len(amf_numbers) - len(audio_files)
 
@@ -1477,7 +2654,7 @@ class dlc(object):
 
 		assert((type(action_code) == tuple) and (len(action_code) == 4))
 
-		sequence_no = self.dlc_sections["XLS"].action_tree[action_code[0]][action_code[1]][action_code[2]][action_code[3]]["seq"]
+		sequence_no = self.dlc_sections["XLS"].lookup(action_code)["seq"]
 		
 		for i in range(3, len(self.dlc_sections["SEQ"].sequences[sequence_no])-1):
 			
@@ -1494,3 +2671,79 @@ class dlc(object):
 			#else:
 			#	self.dlc_sections["SEQ"].sequences[sequence_no][i] = 0x1032
 
+
+#Per-process state for dlc.dump_cels() workers; filled in once per
+#worker by dump_worker_init().
+dump_worker_state = {}
+
+def dump_worker_init(cels, palettes):
+
+	section = dlc.CEL_section()
+	section.cel_array = cels
+	dump_worker_state["section"] = section
+	dump_worker_state["palettes"] = palettes
+
+def dump_worker(task):
+
+	c, p, filename = task
+	im = dump_worker_state["section"].render_cel(c, dump_worker_state["palettes"][p])
+
+	#Use PNGs to preserve transparency.
+	im.save(filename, format="PNG")
+
+
+#Applies patches to DLCs and builds the results, spread over a pool of
+#processes (None for one per core, 1 to do everything in this process.)
+#Each job is a dict of {"base" : dlc path, "patch" : patch (see
+#dlc.apply_patch()), "out" : output path}, so one patch can be applied to
+#many DLCs, or many patches to one DLC.
+#Returns, for each job in turn, {"out", "seconds", "bytes", "error"}.
+def build_variants(jobs, processes=None):
+
+	#Jobs are handed out grouped by base, so that workers can keep
+	#just the one base open at a time.
+	order = sorted(range(len(jobs)), key=lambda n: jobs[n]["base"])
+	jobs = [jobs[n] for n in order]
+
+	if (processes == 1):
+		try:
+			results = [variant_worker(job) for job in jobs]
+		finally:
+			variant_worker_bases.clear()
+	else:
+		pool = multiprocessing.Pool(processes)
+		try:
+			results = pool.map(variant_worker, jobs, 1)
+		finally:
+			pool.close()
+			pool.join()
+
+	in_order = [None] * len(results)
+	for n, result in zip(order, results):
+		in_order[n] = result
+	return in_order
+
+#Each worker parses a base DLC once, and fork()s it for every job that uses it.
+#Only the latest base is kept; dropping the last one (once its forks have
+#been built) unmaps it.
+variant_worker_bases = {}
+
+def variant_worker(job):
+
+	started = time.time()
+	result = {"out" : job["out"], "bytes" : None, "error" : None}
+
+	try:
+		if (job["base"] not in variant_worker_bases):
+			variant_worker_bases.clear()
+			variant_worker_bases[job["base"]] = dlc(job["base"], use_mmap=True)
+
+		D = variant_worker_bases[job["base"]].fork()
+		D.apply_patch(job["patch"])
+		D.build(job["out"])
+		result["bytes"] = os.path.getsize(job["out"])
+	except Exception as e:
+		result["error"] = "%s: %s" % (type(e).__name__, e)
+
+	result["seconds"] = time.time() - started
+	return result